@@ -0,0 +1,346 @@
+"""
+Benchmark the job-runner's hot database paths against a large synthetic history
+
+This generates realistic `job_request` and `job` data at a chosen scale (by
+default 100,000 historical jobs and 1,000 active jobs) and then times the
+queries the job-runner makes most often:
+
+ * those made by `run.handle_jobs` on every tick of the run loop;
+ * the lookups made by `sync.sync` on every poll;
+ * `create_or_update_jobs.recursively_add_jobs` (via
+   `create_jobs_with_project_file`) when handling a new JobRequest;
+ * the partial ID search used by `kill_job` and `retry_job`.
+
+Results are written as JSON so that runs can be compared. Generating a large
+database takes a while so pass `--database` to keep it between runs (it's only
+generated if the file doesn't already exist). Otherwise it's deleted afterwards,
+unless `--keep` is given.
+
+Run from the root of the repository with:
+
+    python -m benchmarks.database_benchmark --history 1000000 --active 5000
+"""
+
+import argparse
+import contextlib
+import json
+from pathlib import Path
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from jobrunner import config
+from jobrunner import run
+from jobrunner.archive_jobs import archive_jobs
+from jobrunner.create_or_update_jobs import create_jobs_with_project_file
+from jobrunner.database import (
+    insert,
+    iter_where,
+    find_where,
+    exists_where,
+    get_connection,
+    select_values,
+    read_only,
+    transaction,
+)
+from jobrunner.find_jobs import find_jobs
+from jobrunner.models import Job, JobDependency, JobRequest, SavedJobRequest, State
+
+DAY = 24 * 60 * 60
+
+# Each JobRequest runs some prefix of this pipeline, with each action depending
+# on the one before
+ACTIONS = [
+    ("generate_cohort", "cohortextractor:latest generate_cohort --output-dir=."),
+    ("prepare_data", "stata-mp:latest analysis/prepare_data.do"),
+    ("fit_model", "r:latest analysis/fit_model.R"),
+    ("make_tables", "python:latest analysis/make_tables.py"),
+    ("make_charts", "python:latest analysis/make_charts.py"),
+]
+
+PROJECT_FILE = """
+version: '1.0'
+actions:
+""" + "".join(
+    f"""
+  action_{i}:
+    run: python:latest analysis/action_{i}.py
+    {f"needs: [action_{i - 1}]" if i else ""}
+    outputs:
+      moderately_sensitive:
+        output: output/action_{i}.csv
+""" for i in range(10)
+)
+
+INSERT_BATCH_SIZE = 10000
+
+
+def main(
+    history,
+    active,
+    workspaces,
+    repeat,
+    database=None,
+    archive=False,
+    output=None,
+    keep=False,
+):
+    random.seed(1234)
+    with working_directory(keep) as tmp_dir:
+        configure(tmp_dir, Path(database) if database else tmp_dir / "db.sqlite")
+        if not config.DATABASE_FILE.exists() or not exists_where(Job):
+            log(f"Generating {history} historical jobs and {active} active jobs")
+            start = time.perf_counter()
+            generate_jobs(history, active, workspaces)
+            log(f"Generated data in {time.perf_counter() - start:.1f}s")
+            if archive:
+                start = time.perf_counter()
+                archived = archive_jobs(days=config.JOB_RETENTION_DAYS)
+                log(f"Archived {archived} jobs in {time.perf_counter() - start:.1f}s")
+        results = run_benchmarks(repeat)
+        report = dict(
+            scale=dict(
+                history=history,
+                active=active,
+                workspaces=workspaces,
+                archive=archive,
+                total_jobs=count_rows("job"),
+                archived_jobs=count_rows("job_history"),
+                database_bytes=config.DATABASE_FILE.stat().st_size,
+            ),
+            sqlite_version=sqlite3.sqlite_version,
+            python_version=sys.version.split()[0],
+            repeat=repeat,
+            results=results,
+        )
+    output_json = json.dumps(report, indent=2)
+    if output:
+        Path(output).write_text(output_json)
+        log(f"Results written to {output}")
+    else:
+        print(output_json)
+
+
+@contextlib.contextmanager
+def working_directory(keep):
+    if keep:
+        tmp_dir = Path(tempfile.mkdtemp())
+        log(f"Keeping working files in {tmp_dir}")
+        yield tmp_dir
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            yield Path(tmp_dir)
+
+
+def configure(tmp_dir, database_file):
+    config.WORK_DIR = tmp_dir
+    config.DATABASE_FILE = database_file
+    config.TMP_DIR = tmp_dir / "temp"
+    config.GIT_REPO_DIR = tmp_dir / "repos"
+    config.BACKUP_DIR = tmp_dir / "backups"
+    config.HIGH_PRIVACY_WORKSPACES_DIR = tmp_dir / "high_privacy" / "workspaces"
+    config.MEDIUM_PRIVACY_WORKSPACES_DIR = tmp_dir / "medium_privacy" / "workspaces"
+    config.JOB_LOG_DIR = tmp_dir / "high_privacy" / "logs"
+
+
+def generate_jobs(history, active, workspaces):
+    now = int(time.time())
+    workspace_names = [f"workspace-{i}" for i in range(workspaces)]
+    jobs_created = 0
+    pending = []
+    while jobs_created < history + active:
+        is_active = jobs_created >= history
+        workspace = random.choice(workspace_names)
+        request = JobRequest(
+            id=random_id(),
+            repo_url=f"https://github.com/opensafely/{workspace}-study",
+            commit=random_id() + random_id(),
+            requested_actions=["run_all"],
+            workspace=workspace,
+            database_name="full",
+            original={"identifier": workspace, "sha": "abc", "padding": "x" * 200},
+        )
+        num_actions = random.randint(1, len(ACTIONS))
+        if is_active:
+            created_at = now - random.randint(0, 6 * 60 * 60)
+        else:
+            created_at = now - random.randint(DAY, 2 * 365 * DAY)
+        pending.append(SavedJobRequest(id=request.id, original=request.original))
+        previous = None
+        for action, run_command in ACTIONS[:num_actions]:
+            job = make_job(
+                request, action, run_command, previous, created_at, is_active
+            )
+            pending.append(job)
+            if previous and is_active:
+                pending.append(JobDependency(job_id=job.id, depends_on_id=previous.id))
+            previous = job
+            jobs_created += 1
+        if len(pending) >= INSERT_BATCH_SIZE:
+            insert_all(pending)
+            pending = []
+    insert_all(pending)
+
+
+def make_job(request, action, run_command, previous, created_at, is_active):
+    if is_active:
+        state = random.choice([State.PENDING, State.PENDING, State.RUNNING])
+        if previous is not None:
+            state = State.PENDING
+        started_at = created_at + 60 if state == State.RUNNING else None
+        completed_at = None
+    else:
+        state = State.SUCCEEDED if random.random() < 0.9 else State.FAILED
+        started_at = created_at + random.randint(1, 600)
+        completed_at = started_at + random.randint(10, 6 * 60 * 60)
+    # Most jobs produce a handful of outputs but a few produce thousands
+    num_outputs = 2000 if random.random() < 0.01 else random.randint(1, 20)
+    return Job(
+        job_request_id=request.id,
+        state=state,
+        repo_url=request.repo_url,
+        commit=request.commit,
+        workspace=request.workspace,
+        database_name=request.database_name,
+        action=action,
+        requires_outputs_from=[previous.action] if previous else [],
+        wait_for_job_ids=[previous.id] if previous else [],
+        run_command=run_command,
+        output_spec={"moderately_sensitive": {"output": f"output/{action}/*.csv"}},
+        outputs=(
+            {
+                f"output/{action}/file_{i}.csv": "moderately_sensitive"
+                for i in range(num_outputs)
+            }
+            if state == State.SUCCEEDED
+            else None
+        ),
+        status_message=(
+            "Completed successfully" if state == State.SUCCEEDED else "Running"
+        ),
+        created_at=created_at,
+        updated_at=completed_at or created_at,
+        started_at=started_at,
+        completed_at=completed_at,
+    )
+
+
+def insert_all(items):
+    with transaction():
+        for item in items:
+            insert(item)
+
+
+def run_benchmarks(repeat):
+    active_request_ids = sorted(
+        set(
+            select_values(
+                Job, "job_request_id", state__in=[State.PENDING, State.RUNNING]
+            )
+        )
+    )
+    sample_job = next(iter_where(Job, order_by="-created_at", limit=1))
+    new_workspace_ids = iter(range(repeat * 10))
+
+    def sync_lookup():
+        with read_only():
+            find_where(Job, job_request_id__in=active_request_ids)
+
+    def add_jobs():
+        workspace = f"benchmark-workspace-{next(new_workspace_ids)}"
+        job_request = JobRequest(
+            id=random_id(),
+            repo_url="https://github.com/opensafely/benchmark",
+            commit="abcdef0123456789",
+            requested_actions=["action_9"],
+            workspace=workspace,
+            database_name="full",
+            original={},
+        )
+        create_jobs_with_project_file(job_request, PROJECT_FILE)
+
+    benchmarks = {
+        "handle_jobs.active_jobs": lambda: list(
+            iter_where(
+                Job,
+                columns=run.ACTIVE_JOB_FIELDS,
+                state__in=[State.PENDING, State.RUNNING],
+            )
+        ),
+        "handle_jobs.ready_to_run": run.get_pending_job_ids_ready_to_run,
+        "handle_jobs.dependency_failed": run.get_pending_job_ids_with_failed_dependency,
+        "handle_jobs.capacity_available": run.job_running_capacity_available,
+        "sync.find_jobs_for_active_requests": sync_lookup,
+        "sync.related_jobs_exist": lambda: exists_where(
+            Job, include_history=True, job_request_id=random_id()
+        ),
+        "create_or_update_jobs.add_10_action_pipeline": add_jobs,
+        "find_jobs.id_prefix": lambda: find_jobs(sample_job.id[:6]),
+        "find_jobs.slug": lambda: find_jobs(sample_job.slug),
+        "find_jobs.action": lambda: find_jobs(sample_job.action),
+    }
+    results = {}
+    for name, func in benchmarks.items():
+        results[name] = time_function(func, repeat)
+        log(f"{name}: {results[name]['median_ms']:.2f}ms")
+    return results
+
+
+def time_function(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return dict(
+        min_ms=min(timings),
+        median_ms=statistics.median(timings),
+        max_ms=max(timings),
+    )
+
+
+def count_rows(table):
+    return get_connection().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def random_id():
+    return "".join(random.choices("abcdefghijklmnopqrstuvwxyz234567", k=16))
+
+
+def log(message):
+    print(message, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n\n")[0])
+    parser.add_argument(
+        "--history", type=int, default=100000, help="Number of historical jobs"
+    )
+    parser.add_argument(
+        "--active", type=int, default=1000, help="Number of active jobs"
+    )
+    parser.add_argument(
+        "--workspaces", type=int, default=500, help="Number of distinct workspaces"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=20, help="Number of times to run each benchmark"
+    )
+    parser.add_argument(
+        "--database", help="Path to database file (generated if it doesn't exist)"
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        help="Archive old jobs after generating data (see archive_jobs.py)",
+    )
+    parser.add_argument("--output", help="Write JSON results to this file")
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the generated database and working files afterwards",
+    )
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,447 @@
+"""
+Benchmark JobRequest intake and status reporting end-to-end against a local
+stand-in for the job-server
+
+This starts a fake job-server implementing the `job-requests` and `jobs`
+endpoints, creates some local git repos to act as studies, and then runs the
+sync loops exactly as `service.py` does while a load generator submits a
+stream of JobRequests at a chosen rate. It measures:
+
+ * intake throughput: JobRequests handled per second, from the first being
+   submitted to the job-server hearing about the jobs for the last;
+ * latency: for each JobRequest, the time from it being submitted to the
+   job-server receiving the first status update for one of its jobs;
+ * the number and size of the requests the job-runner makes, both as sent and
+   before compression.
+
+The run loop isn't started (that needs Docker) so the jobs never get past
+"pending", but that's all we need to exercise sync. Pass `--push` to also send
+each JobRequest to the push intake listener (see `push_intake.py`) rather than
+relying on polling alone.
+
+Results are written as JSON so that runs can be compared. Run from the root of
+the repository with:
+
+    python -m benchmarks.sync_benchmark --requests 1000 --rate 50 --repos 10
+"""
+
+import argparse
+import gzip
+import hashlib
+import http.server
+import json
+import logging
+from pathlib import Path
+import sys
+import threading
+import time
+import urllib.parse
+
+import requests
+
+from benchmarks.database_benchmark import configure, log, working_directory
+from jobrunner import config
+from jobrunner import push_intake
+from jobrunner import sync
+from jobrunner.database import count_where
+from jobrunner.log_utils import configure_logging
+from jobrunner.models import Job
+from jobrunner.subprocess_utils import subprocess_run
+
+TOKEN = "benchmark-token"
+
+
+def main(
+    requests_count,
+    rate,
+    repos,
+    actions,
+    page_size,
+    poll_interval,
+    push=False,
+    timeout=300,
+    output=None,
+    keep=False,
+):
+    with working_directory(keep) as tmp_dir:
+        configure(tmp_dir, tmp_dir / "db.sqlite")
+        log(f"Creating {repos} fixture repos with {actions} actions each")
+        fixture_repos = make_fixture_repos(tmp_dir / "fixtures", repos, actions)
+        servers = []
+        schedulers = []
+        try:
+            server = start_server(FakeJobServer(("127.0.0.1", 0), page_size=page_size))
+            servers.append(server)
+            config.JOB_SERVER_ENDPOINT = (
+                f"http://127.0.0.1:{server.server_port}/api/v2/"
+            )
+            config.JOB_SERVER_TOKEN = TOKEN
+            config.BACKEND = "expectations"
+            config.USING_DUMMY_DATA_BACKEND = True
+            config.POLL_INTERVAL = poll_interval
+            config.SYNC_REPORT_INTERVAL = poll_interval
+            push_url = None
+            if push:
+                push_server = start_server(push_intake.get_server("127.0.0.1", 0))
+                servers.append(push_server)
+                push_url = f"http://127.0.0.1:{push_server.server_port}/job-requests/"
+            schedulers = start_schedulers()
+
+            log(f"Submitting {requests_count} JobRequests at {rate or 'unlimited'}/s")
+            generate_load(server, fixture_repos, requests_count, rate, push_url)
+            if not server.wait_until_reported(requests_count, timeout):
+                log(f"Timed out after {timeout}s waiting for job updates")
+        finally:
+            # Everything has to stop before the working directory goes away
+            stop_schedulers(schedulers)
+            for http_server in servers:
+                http_server.shutdown()
+                http_server.server_close()
+
+        report = dict(
+            scale=dict(
+                requests=requests_count,
+                rate=rate,
+                repos=repos,
+                actions=actions,
+                page_size=page_size,
+                poll_interval=poll_interval,
+                push=push,
+                intake_workers=config.SYNC_INTAKE_WORKERS,
+                batch_size=config.SYNC_BATCH_SIZE,
+                compression_threshold=config.SYNC_COMPRESSION_THRESHOLD,
+            ),
+            python_version=sys.version.split()[0],
+            jobs_created=count_where(Job),
+            results=server.get_results(),
+        )
+    output_json = json.dumps(report, indent=2)
+    if output:
+        Path(output).write_text(output_json)
+        log(f"Results written to {output}")
+    else:
+        print(output_json)
+
+
+def start_schedulers():
+    schedulers = []
+    for scheduler in sync.get_schedulers():
+        thread = threading.Thread(target=scheduler.run_forever, daemon=True)
+        thread.name = scheduler.name
+        thread.start()
+        schedulers.append((scheduler, thread))
+    return schedulers
+
+
+def stop_schedulers(schedulers):
+    for scheduler, _ in schedulers:
+        scheduler.stop()
+    for _, thread in schedulers:
+        thread.join()
+
+
+def start_server(server):
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    return server
+
+
+def make_fixture_repos(fixtures_dir, count, actions):
+    """
+    Create `count` bare git repos, each containing a project.yaml whose actions
+    form a single chain, and return a list of (repo path, commit SHA) pairs
+    """
+    project_dir = fixtures_dir / "project"
+    project_dir.mkdir(parents=True)
+    (project_dir / "project.yaml").write_text(make_project_file(actions))
+    fixture_repos = []
+    for i in range(count):
+        repo_path = fixtures_dir / f"study-{i}"
+        subprocess_run(["git", "init", "--bare", "--quiet", repo_path], check=True)
+        env = {"GIT_WORK_TREE": project_dir, "GIT_DIR": repo_path}
+        git_commands = [
+            ["config", "user.email", "benchmark@example.com"],
+            ["config", "user.name", "Benchmark"],
+            ["add", "."],
+            ["commit", "--quiet", "-m", f"Study {i}"],
+        ]
+        for args in git_commands:
+            subprocess_run(["git"] + args, check=True, env=env)
+        response = subprocess_run(
+            ["git", "rev-parse", "HEAD"],
+            check=True,
+            capture_output=True,
+            text=True,
+            env=env,
+        )
+        fixture_repos.append((str(repo_path), response.stdout.strip()))
+    return fixture_repos
+
+
+def make_project_file(actions):
+    lines = ["version: '1.0'", "actions:"]
+    for i in range(actions):
+        lines.append(f"  action_{i}:")
+        lines.append(f"    run: python:latest analysis/action_{i}.py")
+        if i:
+            lines.append(f"    needs: [action_{i - 1}]")
+        lines.append("    outputs:")
+        lines.append("      moderately_sensitive:")
+        lines.append(f"        output: output/action_{i}.csv")
+    return "\n".join(lines) + "\n"
+
+
+def generate_load(server, fixture_repos, count, rate, push_url=None):
+    """
+    Submit `count` JobRequests to the job-server, spread evenly over the
+    fixture repos, at `rate` per second (or all at once if `rate` is 0)
+    """
+    session = requests.Session()
+    session.headers["Authorization"] = TOKEN
+    start = time.perf_counter()
+    for i in range(count):
+        if rate:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        repo_path, commit = fixture_repos[i % len(fixture_repos)]
+        job_request = {
+            "identifier": f"request-{i}",
+            "requested_actions": ["run_all"],
+            "force_run_dependencies": False,
+            "sha": commit,
+            "workspace": {
+                "name": f"workspace-{i}",
+                "repo": repo_path,
+                "branch": "main",
+                "db": "dummy",
+            },
+        }
+        server.add_job_request(job_request)
+        if push_url:
+            session.post(push_url, json=job_request).raise_for_status()
+
+
+class FakeJobServer(http.server.ThreadingHTTPServer):
+    """
+    Just enough of the job-server's API for sync to talk to, recording what it
+    gets sent
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, page_size=None):
+        super().__init__(server_address, FakeJobServerHandler)
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.reported = threading.Condition(self.lock)
+        self.job_requests = []
+        self.submitted_at = {}
+        self.first_reported_at = {}
+        self.gets = 0
+        self.not_modified = 0
+        self.post_sizes = []
+        self.uncompressed_bytes = 0
+        self.jobs_received = 0
+
+    def add_job_request(self, job_request):
+        with self.lock:
+            self.job_requests.append(job_request)
+            self.submitted_at[job_request["identifier"]] = time.perf_counter()
+
+    def get_page(self, cursor):
+        with self.lock:
+            self.gets += 1
+            end = cursor + (self.page_size or len(self.job_requests))
+            page = {"results": self.job_requests[cursor:end], "next": None}
+            if end < len(self.job_requests):
+                host, port = self.server_address
+                page["next"] = (
+                    f"http://{host}:{port}/api/v2/job-requests/"
+                    f"?backend={config.BACKEND}&cursor={end}"
+                )
+            return page
+
+    def record_jobs(self, jobs, size, uncompressed_size):
+        now = time.perf_counter()
+        with self.lock:
+            self.post_sizes.append(size)
+            self.uncompressed_bytes += uncompressed_size
+            self.jobs_received += len(jobs)
+            for job in jobs:
+                self.first_reported_at.setdefault(job["job_request_id"], now)
+            self.reported.notify_all()
+
+    def wait_until_reported(self, count, timeout):
+        with self.lock:
+            return self.reported.wait_for(
+                lambda: len(self.first_reported_at) >= count, timeout=timeout
+            )
+
+    def get_results(self):
+        with self.lock:
+            latencies = [
+                reported_at - self.submitted_at[job_request_id]
+                for job_request_id, reported_at in self.first_reported_at.items()
+            ]
+            if self.first_reported_at:
+                duration = max(self.first_reported_at.values()) - min(
+                    self.submitted_at.values()
+                )
+            else:
+                duration = None
+            return dict(
+                intake=dict(
+                    submitted=len(self.submitted_at),
+                    reported=len(self.first_reported_at),
+                    seconds=duration,
+                    requests_per_second=(
+                        len(self.first_reported_at) / duration if duration else None
+                    ),
+                ),
+                latency=summarise(latencies),
+                job_requests_gets=dict(
+                    total=self.gets + self.not_modified,
+                    not_modified=self.not_modified,
+                ),
+                jobs_posts=dict(
+                    total=len(self.post_sizes),
+                    jobs=self.jobs_received,
+                    bytes_sent=sum(self.post_sizes),
+                    bytes_uncompressed=self.uncompressed_bytes,
+                    sizes=summarise(self.post_sizes),
+                ),
+            )
+
+
+class FakeJobServerHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path.rstrip("/") != "/api/v2/job-requests":
+            return self.respond(404, {"error": "Not found"})
+        if self.headers.get("Authorization") != TOKEN:
+            return self.respond(401, {"error": "Invalid token"})
+        query = urllib.parse.parse_qs(url.query)
+        page = self.server.get_page(int(query.get("cursor", ["0"])[0]))
+        body = json.dumps(page).encode("utf8")
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            with self.server.lock:
+                self.server.gets -= 1
+                self.server.not_modified += 1
+            return self.respond(304, None, {"ETag": etag})
+        self.respond(200, body, {"ETag": etag})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/api/v2/jobs":
+            return self.respond(404, {"error": "Not found"})
+        if self.headers.get("Authorization") != TOKEN:
+            return self.respond(401, {"error": "Invalid token"})
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        size = len(body)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.server.record_jobs(json.loads(body), size, len(body))
+        self.respond(200, {})
+
+    def respond(self, status, data, headers=None):
+        if isinstance(data, bytes) or data is None:
+            body = data or b""
+        else:
+            body = json.dumps(data).encode("utf8")
+        headers = dict(headers or {})
+        if body and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def summarise(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def percentile(p):
+        return values[round(p / 100 * (len(values) - 1))]
+
+    return dict(
+        min=values[0],
+        median=percentile(50),
+        p90=percentile(90),
+        p99=percentile(99),
+        max=values[-1],
+        mean=sum(values) / len(values),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n\n")[0])
+    parser.add_argument(
+        "--requests",
+        dest="requests_count",
+        type=int,
+        default=500,
+        help="Number of JobRequests to submit",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=20,
+        help="JobRequests submitted per second (0 to submit them all at once)",
+    )
+    parser.add_argument(
+        "--repos", type=int, default=10, help="Number of distinct study repos"
+    )
+    parser.add_argument(
+        "--actions", type=int, default=5, help="Number of actions in each study"
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=None,
+        help="Paginate job-requests responses with this many per page",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=1.0,
+        help="Value of POLL_INTERVAL (and SYNC_REPORT_INTERVAL) to use",
+    )
+    parser.add_argument(
+        "--push",
+        action="store_true",
+        help="Also push JobRequests to the push intake listener",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=300,
+        help="Seconds to wait for the job-server to hear about every JobRequest",
+    )
+    parser.add_argument("--output", help="Write JSON results to this file")
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the database and repos afterwards rather than deleting them",
+    )
+    parser.add_argument(
+        "--log-level", default="WARNING", help="Log level for the job-runner"
+    )
+    args = parser.parse_args()
+    configure_logging(stream=sys.stderr)
+    logging.getLogger().setLevel(args.log_level)
+    kwargs = vars(args)
+    kwargs.pop("log_level")
+    main(**kwargs)
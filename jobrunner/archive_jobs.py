@@ -0,0 +1,75 @@
+"""
+Ops utility for moving old, finished jobs out of the main `job` table and into
+the `job_history` table
+
+The application only ever needs to query active and recently completed jobs so
+by keeping the `job` table small we keep those queries fast, however many jobs
+we've run in total. Archived jobs can still be retrieved by passing
+`include_history=True` to the relevant functions in `database.py`.
+"""
+import argparse
+import logging
+import time
+
+from . import config
+from .database import archive_where, delete_where, select_values
+from .log_utils import configure_logging
+from .models import Job, JobDependency, State
+
+
+log = logging.getLogger(__name__)
+
+# Archive in batches so that we never hold the write lock for long enough to
+# hold up the run loop
+BATCH_SIZE = 500
+
+
+def main(days=None):
+    archived = archive_jobs(days)
+    log.info(f"Archived {archived} jobs")
+
+
+def archive_jobs(days=None):
+    """
+    Move jobs which have been in a terminal state for more than `days` days
+    into the history table, returning the number of jobs moved
+    """
+    if days is None:
+        days = config.JOB_RETENTION_DAYS
+    cutoff = int(time.time() - days * 24 * 60 * 60)
+    job_ids = select_values(
+        Job,
+        "id",
+        state__in=[State.FAILED, State.SUCCEEDED],
+        completed_at__lt=cutoff,
+    )
+    # Never archive a job which an active job is waiting on, otherwise the run
+    # loop wouldn't be able to find out what state it finished in
+    awaited_job_ids = set()
+    for wait_for_job_ids in select_values(
+        Job, "wait_for_job_ids", state__in=[State.PENDING, State.RUNNING]
+    ):
+        awaited_job_ids.update(wait_for_job_ids or [])
+    job_ids = [job_id for job_id in job_ids if job_id not in awaited_job_ids]
+    archived = 0
+    for i in range(0, len(job_ids), BATCH_SIZE):
+        batch = job_ids[i : i + BATCH_SIZE]
+        archived += archive_where(Job, id__in=batch)
+        # Finished jobs never need their dependencies checking again
+        delete_where(JobDependency, job_id__in=batch)
+    return archived
+
+
+if __name__ == "__main__":
+    configure_logging()
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n\n")[0])
+    parser.add_argument(
+        "--days",
+        type=float,
+        help=(
+            "Archive jobs which finished more than this many days ago "
+            f"(default {config.JOB_RETENTION_DAYS})"
+        ),
+    )
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,114 @@
+"""
+Takes online snapshots of the job-runner database
+
+These use SQLite's backup API from a separate connection which holds a single
+read transaction open for the whole copy, so each snapshot is consistent even
+while the run loop and sync thread are writing to the database. As the
+database is in WAL mode that read never blocks writers. The copy is made a few
+pages at a time with a pause between each step to limit the load it puts on
+the disk.
+
+Snapshots are written to `BACKUP_DIR` and the oldest ones are deleted once
+there are more than `BACKUP_COUNT` of them.
+"""
+import datetime
+import logging
+import sqlite3
+import sys
+import time
+
+from . import config
+from .log_utils import configure_logging
+
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    log.info(
+        f"Backing up database to {config.BACKUP_DIR} every {config.BACKUP_INTERVAL}s"
+    )
+    delete_incomplete_backups()
+    while True:
+        time.sleep(config.BACKUP_INTERVAL)
+        backup_database()
+
+
+def backup_database():
+    """
+    Write a new snapshot of the database, delete any old snapshots and return
+    the path to the new one
+    """
+    config.BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    destination = config.BACKUP_DIR / f"db-{timestamp}.sqlite"
+    tmp_destination = destination.with_suffix(".sqlite.tmp")
+    start = time.time()
+    try:
+        copy_database(
+            config.DATABASE_FILE,
+            tmp_destination,
+            pages=config.BACKUP_PAGES_PER_STEP,
+            step_sleep=config.BACKUP_STEP_SLEEP,
+        )
+        # Only give the file its final name once it's complete so a half-written
+        # backup never looks like a valid one
+        tmp_destination.replace(destination)
+    finally:
+        if tmp_destination.exists():
+            tmp_destination.unlink()
+    size = destination.stat().st_size
+    log.info(f"Backed up {size} bytes to {destination} in {time.time() - start:.1f}s")
+    delete_old_backups()
+    return destination
+
+
+def copy_database(source_file, destination_file, pages, step_sleep=0):
+    def progress(status, remaining, total):
+        # Sleeping here, between steps, is what throttles the backup
+        if remaining and step_sleep:
+            time.sleep(step_sleep)
+
+    # We deliberately don't use `database.get_connection` here as we want a
+    # separate connection which isn't shared with anything else
+    source = sqlite3.connect(str(source_file), isolation_level=None)
+    destination = sqlite3.connect(str(destination_file))
+    try:
+        # Otherwise SQLite starts the copy again from scratch whenever another
+        # connection writes to the database, and on a busy database a throttled
+        # backup would never finish. Holding a read transaction means every step
+        # copies from the same snapshot. The cost is that the WAL can't be
+        # checkpointed past that snapshot until we're done, so it grows a little
+        # while the backup runs.
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        source.backup(destination, pages=pages, progress=progress)
+        source.execute("COMMIT")
+    finally:
+        destination.close()
+        source.close()
+
+
+def delete_incomplete_backups():
+    """
+    Delete any partial backups left behind if we crashed part way through one
+    """
+    for tmp_file in config.BACKUP_DIR.glob("db-*.sqlite.tmp"):
+        log.info(f"Deleting incomplete backup {tmp_file}")
+        tmp_file.unlink()
+
+
+def delete_old_backups():
+    backups = sorted(config.BACKUP_DIR.glob("db-*.sqlite"))
+    for backup in backups[: -config.BACKUP_COUNT]:
+        log.info(f"Deleting old backup {backup}")
+        backup.unlink()
+
+
+if __name__ == "__main__":
+    configure_logging()
+
+    try:
+        backup_database()
+    except KeyboardInterrupt:
+        sys.exit(0)
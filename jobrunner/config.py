@@ -13,6 +13,25 @@ GIT_REPO_DIR = WORK_DIR / "repos"
 
 DATABASE_FILE = WORK_DIR / "db.sqlite"
 
+# Online snapshots of the database, see `backup.py`
+BACKUP_DIR = WORK_DIR / "backups"
+# Seconds between backups (set to 0 to disable)
+BACKUP_INTERVAL = float(os.environ.get("BACKUP_INTERVAL", 6 * 60 * 60))
+# Number of snapshots to keep
+BACKUP_COUNT = int(os.environ.get("BACKUP_COUNT", "4"))
+# Backups are copied a few pages at a time, pausing between each step, so they
+# don't compete with the run loop for disk bandwidth
+BACKUP_PAGES_PER_STEP = int(os.environ.get("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP = float(os.environ.get("BACKUP_STEP_SLEEP", "0.05"))
+
+# Seconds between runs of the database maintenance task, see `maintenance.py`
+# (set to 0 to disable)
+MAINTENANCE_INTERVAL = float(os.environ.get("MAINTENANCE_INTERVAL", 24 * 60 * 60))
+# Free pages are returned to the filesystem this many at a time, sleeping for
+# this many seconds between each slice
+MAINTENANCE_VACUUM_PAGES = int(os.environ.get("MAINTENANCE_VACUUM_PAGES", "1000"))
+MAINTENANCE_SLICE_SLEEP = float(os.environ.get("MAINTENANCE_SLICE_SLEEP", "0.1"))
+
 HIGH_PRIVACY_STORAGE_BASE = Path(
     os.environ.get("HIGH_PRIVACY_STORAGE_BASE", WORK_DIR / "high_privacy")
 )
@@ -33,8 +52,49 @@ JOB_SERVER_TOKEN = os.environ.get("JOB_SERVER_TOKEN", "token")
 PRIVATE_REPO_ACCESS_TOKEN = os.environ.get("PRIVATE_REPO_ACCESS_TOKEN", "")
 
 POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", "5"))
+# If set, listen on this port for JobRequests pushed to us by the job-server
+# (as well as polling for them), see `push_intake.py`
+PUSH_INTAKE_PORT = int(os.environ.get("PUSH_INTAKE_PORT") or 0)
+PUSH_INTAKE_HOST = os.environ.get("PUSH_INTAKE_HOST", "127.0.0.1")
+# Largest pushed request body we'll accept, in bytes, both as sent and after
+# decompression
+PUSH_INTAKE_MAX_BODY_SIZE = int(
+    os.environ.get("PUSH_INTAKE_MAX_BODY_SIZE", str(10 * 1024 * 1024))
+)
+# How often we POST job updates to the job-server, independently of polling
+# for JobRequests (state changes get sent straight away regardless)
+SYNC_REPORT_INTERVAL = float(
+    os.environ.get("SYNC_REPORT_INTERVAL", str(POLL_INTERVAL))
+)
 JOB_LOOP_INTERVAL = float(os.environ.get("JOB_LOOP_INTERVAL", "1.0"))
 
+# Number of JobRequests we'll fetch code for and create jobs from at once (those
+# for the same repo are always handled one at a time), see `sync`
+SYNC_INTAKE_WORKERS = int(os.environ.get("SYNC_INTAKE_WORKERS", "4"))
+# Maximum number of job updates to POST to the job-server in one request, see
+# `sync.send_job_updates`
+SYNC_BATCH_SIZE = int(os.environ.get("SYNC_BATCH_SIZE", "500"))
+# Request bodies bigger than this many bytes get gzipped before sending to the
+# job-server. This is off (0) by default as it should only be enabled once the
+# job-server is known to accept gzipped request bodies.
+SYNC_COMPRESSION_THRESHOLD = int(os.environ.get("SYNC_COMPRESSION_THRESHOLD", "0"))
+# When the job-server is unavailable we back off exponentially from
+# POLL_INTERVAL (or SYNC_REPORT_INTERVAL) up to this many seconds between
+# attempts
+SYNC_MAX_BACKOFF = float(os.environ.get("SYNC_MAX_BACKOFF", "300"))
+# When a job changes state we send the update to the job-server straight away
+# rather than waiting for SYNC_REPORT_INTERVAL, after waiting this many seconds
+# to see if any other jobs change state which we can send at the same time
+SYNC_PUSH_DELAY = float(os.environ.get("SYNC_PUSH_DELAY", "0.2"))
+# Normally we only POST jobs which have changed, but every so often (and on
+# startup) we POST every job for every active JobRequest just in case the
+# job-server has somehow got out of step
+SYNC_FULL_RESYNC_INTERVAL = float(os.environ.get("SYNC_FULL_RESYNC_INTERVAL", "3600"))
+
+# Jobs which have been in a terminal state for longer than this get moved out
+# of the main `job` table, see `archive_jobs.py`
+JOB_RETENTION_DAYS = float(os.environ.get("JOB_RETENTION_DAYS", "30"))
+
 BACKEND = os.environ.get("BACKEND", "expectations")
 
 USING_DUMMY_DATA_BACKEND = BACKEND == "expectations"
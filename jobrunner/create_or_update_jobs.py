@@ -5,13 +5,22 @@ It handles all logic connected with creating or updating Jobs in response to
 JobRequests. This includes fetching the code with git, validating the project
 and doing the necessary dependency resolution.
 """
+import collections
 import logging
 from pathlib import Path
 import re
+import threading
 import time
 
 from . import config
-from .database import transaction, insert, exists_where, find_where, count_where
+from .database import (
+    transaction,
+    insert,
+    exists_where,
+    find_where,
+    count_where,
+    get_connection,
+)
 from .git import (
     read_file_from_repo,
     get_sha_from_remote_ref,
@@ -26,7 +35,7 @@ from .project import (
     ProjectValidationError,
     RUN_ALL_COMMAND,
 )
-from .models import Job, SavedJobRequest, State
+from .models import Job, JobDependency, JobOutboxItem, SavedJobRequest, State
 from .manage_jobs import action_has_successful_outputs
 
 
@@ -61,6 +70,7 @@ def create_or_update_jobs(job_request):
         except Exception:
             log.exception("Uncaught error while creating jobs")
             create_failed_job(job_request, JobRequestError("Internal error"))
+        known_job_requests.add(job_request.id)
     else:
         # TODO: think about what sort of updates we want to support
         # I think these are probably limited to:
@@ -78,7 +88,66 @@ def create_or_update_jobs(job_request):
 
 
 def related_jobs_exist(job_request):
-    return exists_where(Job, job_request_id=job_request.id)
+    if job_request.id in known_job_requests:
+        return True
+    # Include archived jobs, otherwise we'd end up re-running any old
+    # JobRequests which the job-server still considers active
+    if exists_where(Job, include_history=True, job_request_id=job_request.id):
+        known_job_requests.add(job_request.id)
+        return True
+    return False
+
+
+class KnownJobRequests:
+    """
+    The IDs of JobRequests which we know have already been handled
+
+    The job-server returns every active JobRequest on every poll and almost all
+    of them will be ones we've already handled, so this saves us a database
+    query for each one. It's initially filled from the `job` table and holds at
+    most `max_size` IDs, forgetting the least recently used ones first. A miss
+    just means we check the database as normal.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.ids = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.database_file = None
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, job_request_id):
+        with self.lock:
+            self.load_if_needed()
+            if job_request_id in self.ids:
+                self.ids.move_to_end(job_request_id)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, job_request_id):
+        with self.lock:
+            self.load_if_needed()
+            self.ids[job_request_id] = True
+            self.ids.move_to_end(job_request_id)
+            while len(self.ids) > self.max_size:
+                self.ids.popitem(last=False)
+
+    def load_if_needed(self):
+        # Checking the database file means we start afresh if it changes, which
+        # in practice only happens in tests
+        if self.database_file == config.DATABASE_FILE:
+            return
+        self.database_file = config.DATABASE_FILE
+        # This can be answered entirely from the `idx_job__job_request_id` index
+        sql = "SELECT DISTINCT job_request_id FROM job LIMIT ?"
+        rows = get_connection().execute(sql, [self.max_size])
+        self.ids = collections.OrderedDict((row[0], True) for row in rows)
+
+
+known_job_requests = KnownJobRequests(max_size=100000)
 
 
 def create_jobs(job_request):
@@ -195,6 +264,9 @@ def recursively_add_jobs(job_request, project, action, force_run_actions):
         updated_at=int(time.time()),
     )
     insert(job)
+    insert(JobOutboxItem(job_id=job.id))
+    for wait_for_job_id in wait_for_job_ids:
+        insert(JobDependency(job_id=job.id, depends_on_id=wait_for_job_id))
     return job
 
 
@@ -249,18 +321,18 @@ def create_failed_job(job_request, exception):
     with transaction():
         insert(SavedJobRequest(id=job_request.id, original=job_request.original))
         now = int(time.time())
-        insert(
-            Job(
-                job_request_id=job_request.id,
-                state=state,
-                repo_url=job_request.repo_url,
-                commit=job_request.commit,
-                workspace=job_request.workspace,
-                action=job_request.requested_actions[0],
-                status_message=status_message,
-                created_at=now,
-                started_at=now,
-                updated_at=now,
-                completed_at=now,
-            ),
+        job = Job(
+            job_request_id=job_request.id,
+            state=state,
+            repo_url=job_request.repo_url,
+            commit=job_request.commit,
+            workspace=job_request.workspace,
+            action=job_request.requested_actions[0],
+            status_message=status_message,
+            created_at=now,
+            started_at=now,
+            updated_at=now,
+            completed_at=now,
         )
+        insert(job)
+        insert(JobOutboxItem(job_id=job.id))
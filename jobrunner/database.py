@@ -8,17 +8,39 @@ something like SQLAlchemny, pinned to a known compromise-free version. The API
 surface area of this module is sufficiently small that swapping it out
 shouldn't be too large a job.
 """
+import contextlib
 import dataclasses
 from enum import Enum
+import functools
 import json
 from pathlib import Path
 import sqlite3
 import threading
+import zlib
 
 from . import config
 
 
 CONNECTION_CACHE = threading.local()
+READ_ONLY = threading.local()
+# Tracks how deeply nested in `transaction` blocks the current thread is, and
+# whether it's within `batched_writes`
+TRANSACTION_STATE = threading.local()
+
+# Sorts after any other character, used for prefix matching
+MAX_CHAR = "\U0010ffff"
+
+# Values of any fields listed in a class's `__compressed_fields__` which encode
+# to more than this many bytes of JSON get compressed and stored in the class's
+# blob table, rather than in the main table, in order to keep the main table's
+# rows small. They're only loaded from the blob table when first accessed.
+COMPRESSION_THRESHOLD = 1024
+# Stored in the main table in place of values which have been moved to the blob
+# table. This isn't valid JSON so can't be confused with a real value.
+COMPRESSED_MARKER = "compressed"
+# Returned by `decode_field_values` in place of values which haven't been
+# loaded from the blob table
+NOT_LOADED = object()
 
 
 def insert(item):
@@ -27,12 +49,27 @@ def insert(item):
     columns = ", ".join(escape(field.name) for field in fields)
     placeholders = ", ".join(["?"] * len(fields))
     sql = f"INSERT INTO {escape(table)} ({columns}) VALUES({placeholders})"
-    get_connection().execute(sql, encode_field_values(fields, item))
+    values = encode_field_values(fields, item)
+    values, blob_writes = compress_values(item, fields, values, is_update=False)
+    with maybe_transaction(blob_writes) as conn:
+        conn.execute(sql, values)
+        write_blobs(conn, blob_writes)
+    mark_clean(item)
 
 
 def update(item, update_fields=None):
+    """
+    Write the item's fields back to the database. By default, for classes
+    which track which fields have been changed (see `models.Job`), only the
+    changed fields are written and if nothing has changed nothing is written.
+    Otherwise all fields are written unless `update_fields` specifies a subset.
+    """
     assert item.id
     table = item.__tablename__
+    if update_fields is None:
+        update_fields = getattr(item, "_dirty_fields", None)
+        if update_fields is not None and not update_fields:
+            return
     if update_fields is not None:
         fields = [f for f in dataclasses.fields(item) if f.name in update_fields]
         assert fields
@@ -40,27 +77,177 @@ def update(item, update_fields=None):
         fields = dataclasses.fields(item)
     updates = ", ".join(f"{escape(field.name)} = ?" for field in fields)
     update_params = encode_field_values(fields, item)
+    update_params, blob_writes = compress_values(item, fields, update_params)
     where, where_params = query_params_to_sql({"id": item.id})
-    get_connection().execute(
-        f"UPDATE {escape(table)} SET {updates} WHERE {where}",
-        update_params + where_params,
+    with maybe_transaction(blob_writes) as conn:
+        conn.execute(
+            f"UPDATE {escape(table)} SET {updates} WHERE {where}",
+            update_params + where_params,
+        )
+        write_blobs(conn, blob_writes)
+    mark_clean(item, [field.name for field in fields])
+
+
+def compress_values(item, fields, values, is_update=True):
+    """
+    Compress any large values of compressible fields, returning the list of
+    values with these replaced by the COMPRESSED_MARKER, along with the SQL
+    statements needed to bring the blob table into line. These must be run in
+    the same transaction as, and after, the write to the main table so that a
+    failed write never touches the blob table.
+    """
+    compressed_fields = getattr(item, "__compressed_fields__", ())
+    if not compressed_fields:
+        return values, []
+    blob_table = escape(item.__blob_tablename__)
+    values = list(values)
+    blob_writes = []
+    for i, field in enumerate(fields):
+        if field.name not in compressed_fields:
+            continue
+        value = values[i]
+        if value is not None and len(value) > COMPRESSION_THRESHOLD:
+            # A new item can't already have any blobs so we use a plain INSERT,
+            # which fails loudly rather than overwriting one if it somehow does
+            verb = "INSERT OR REPLACE" if is_update else "INSERT"
+            blob_writes.append(
+                (
+                    f"{verb} INTO {blob_table} (id, field, data) VALUES (?, ?, ?)",
+                    [item.id, field.name, zlib.compress(value.encode("utf-8"))],
+                )
+            )
+            values[i] = COMPRESSED_MARKER
+        elif is_update:
+            blob_writes.append(
+                (
+                    f"DELETE FROM {blob_table} WHERE id = ? AND field = ?",
+                    [item.id, field.name],
+                )
+            )
+    return values, blob_writes
+
+
+def write_blobs(conn, blob_writes):
+    for sql, params in blob_writes:
+        conn.execute(sql, params)
+
+
+@contextlib.contextmanager
+def maybe_transaction(needed):
+    """
+    Wrap the block in a transaction if `needed`, yielding the connection
+    either way (this saves the overhead of a transaction for the common case
+    of a single statement)
+    """
+    if needed:
+        with transaction() as conn:
+            yield conn
+    else:
+        yield get_write_connection()
+
+
+def load_compressed_value(itemclass, item_id, field_name):
+    field = [f for f in dataclasses.fields(itemclass) if f.name == field_name][0]
+    blob_table = escape(itemclass.__blob_tablename__)
+    row = (
+        get_connection()
+        .execute(
+            f"SELECT data FROM {blob_table} WHERE id = ? AND field = ?",
+            [item_id, field_name],
+        )
+        .fetchone()
     )
+    value = zlib.decompress(row["data"]).decode("utf-8")
+    return decode_field_values([field], {field_name: value})[0]
 
 
-def find_where(itemclass, **query_params):
-    table = itemclass.__tablename__
-    fields = dataclasses.fields(itemclass)
-    where, params = query_params_to_sql(query_params)
-    sql = f"SELECT * FROM {escape(table)} WHERE {where}"
-    cursor = get_connection().execute(sql, params)
-    return [itemclass(*decode_field_values(fields, row)) for row in cursor]
+def mark_clean(item, field_names=None):
+    """
+    Record that the item's fields (or just the named fields) now match what's
+    in the database
+    """
+    dirty_fields = getattr(item, "_dirty_fields", None)
+    if dirty_fields is None:
+        return
+    if field_names is None:
+        dirty_fields.clear()
+    else:
+        dirty_fields.difference_update(field_names)
 
 
-def exists_where(itemclass, **query_params):
-    table = itemclass.__tablename__
-    where, params = query_params_to_sql(query_params)
-    sql = f"SELECT EXISTS (SELECT 1 FROM {escape(table)} WHERE {where})"
+def find_where(itemclass, include_history=False, **query_params):
+    return list(iter_where(itemclass, include_history=include_history, **query_params))
+
+
+def iter_where(
+    itemclass,
+    columns=None,
+    order_by=None,
+    limit=None,
+    include_history=False,
+    **query_params,
+):
+    """
+    Like `find_where` but returns an iterator which yields items as they're
+    read from the database, rather than reading them all into memory at once.
+
+    If `columns` is supplied then only those fields are loaded (and decoded),
+    all others are left with their default values. It's still safe to pass
+    these partial items to `update` as only the fields which get changed will
+    be written.
+
+    `order_by` is a field name, optionally prefixed with "-" to sort in
+    descending order.
+    """
+    all_fields = dataclasses.fields(itemclass)
+    if columns is None:
+        fields = all_fields
+    else:
+        fields = [f for f in all_fields if f.name in columns]
+        assert len(fields) == len(set(columns))
+    column_names = [field.name for field in fields]
+    order_sql = ""
+    if order_by is not None:
+        order_column = order_by.lstrip("-")
+        assert order_column in [field.name for field in all_fields]
+        # The sort column has to be selected for ORDER BY to work on a UNION
+        if order_column not in column_names:
+            column_names.append(order_column)
+        direction = "DESC" if order_by.startswith("-") else "ASC"
+        order_sql = f" ORDER BY {escape(order_column)} {direction}"
+    columns_sql = ", ".join(escape(name) for name in column_names)
+    sql, params = select_sql(itemclass, columns_sql, query_params, include_history)
+    sql += order_sql
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
     cursor = get_connection().execute(sql, params)
+    for row in cursor:
+        values = decode_field_values(fields, row)
+        not_loaded = [f.name for f, v in zip(fields, values) if v is NOT_LOADED]
+        item = itemclass(**{f.name: value for f, value in zip(fields, values)})
+        for name in not_loaded:
+            item.set_lazy_value(
+                name, functools.partial(load_compressed_value, itemclass, item.id, name)
+            )
+        mark_clean(item)
+        yield item
+
+
+def reload(item):
+    """
+    Re-read all the item's fields from the database, in place (useful for
+    filling in the rest of a partial item loaded by `iter_where`)
+    """
+    loaded = find_where(type(item), id=item.id)[0]
+    for field in dataclasses.fields(item):
+        setattr(item, field.name, getattr(loaded, field.name))
+    mark_clean(item)
+
+
+def exists_where(itemclass, include_history=False, **query_params):
+    sql, params = select_sql(itemclass, "1", query_params, include_history)
+    cursor = get_connection().execute(f"SELECT EXISTS ({sql})", params)
     return bool(cursor.fetchone()[0])
 
 
@@ -72,27 +259,200 @@ def count_where(itemclass, **query_params):
     return cursor.fetchone()[0]
 
 
-def select_values(itemclass, column, **query_params):
-    table = itemclass.__tablename__
+def select_values(itemclass, column, include_history=False, **query_params):
     fields = [f for f in dataclasses.fields(itemclass) if f.name == column]
     assert fields
-    where, params = query_params_to_sql(query_params)
-    sql = f"SELECT {escape(column)} FROM {escape(table)} WHERE {where}"
+    # We can't load compressed values without knowing which item they belong to
+    assert column not in getattr(itemclass, "__compressed_fields__", ())
+    sql, params = select_sql(itemclass, escape(column), query_params, include_history)
     cursor = get_connection().execute(sql, params)
     return [decode_field_values(fields, row)[0] for row in cursor]
 
 
+def select_sql(itemclass, columns, query_params, include_history=False):
+    """
+    Build a SELECT query (and its parameters) for the supplied columns. If
+    `include_history` is set then archived items from the class's history
+    table are included in the results as well.
+    """
+    tables = [itemclass.__tablename__]
+    if include_history:
+        tables.append(itemclass.__history_tablename__)
+    where, params = query_params_to_sql(query_params)
+    sql = " UNION ALL ".join(
+        f"SELECT {columns} FROM {escape(table)} WHERE {where}" for table in tables
+    )
+    return sql, params * len(tables)
+
+
+def archive_where(itemclass, **query_params):
+    """
+    Move all matching items out of the class's main table and into its history
+    table (which has an identical schema), returning the number of items moved.
+    This happens in a single transaction so items are never visible in both
+    tables or neither.
+
+    Any values held in the blob table are written back into the history table
+    (uncompressed) and removed from the blob table, so the blob table only
+    ever holds values for items in the main table.
+    """
+    table = escape(itemclass.__tablename__)
+    history_table = escape(itemclass.__history_tablename__)
+    fields = dataclasses.fields(itemclass)
+    columns = ", ".join(escape(field.name) for field in fields)
+    where, params = query_params_to_sql(query_params)
+    with transaction() as conn:
+        conn.execute(
+            f"INSERT OR REPLACE INTO {history_table} ({columns}) "
+            f"SELECT {columns} FROM {table} WHERE {where}",
+            params,
+        )
+        if hasattr(itemclass, "__blob_tablename__"):
+            blob_table = escape(itemclass.__blob_tablename__)
+            blob_where = f"id IN (SELECT id FROM {table} WHERE {where})"
+            blobs = conn.execute(
+                f"SELECT id, field, data FROM {blob_table} WHERE {blob_where}",
+                params,
+            ).fetchall()
+            for blob in blobs:
+                conn.execute(
+                    f"UPDATE {history_table} SET {escape(blob['field'])} = ? "
+                    "WHERE id = ?",
+                    [zlib.decompress(blob["data"]).decode("utf-8"), blob["id"]],
+                )
+            conn.execute(f"DELETE FROM {blob_table} WHERE {blob_where}", params)
+        cursor = conn.execute(f"DELETE FROM {table} WHERE {where}", params)
+    return cursor.rowcount
+
+
+def delete_where(itemclass, **query_params):
+    table = escape(itemclass.__tablename__)
+    where, params = query_params_to_sql(query_params)
+    blob_tablename = getattr(itemclass, "__blob_tablename__", None)
+    with maybe_transaction(blob_tablename) as conn:
+        if blob_tablename:
+            conn.execute(
+                f"DELETE FROM {escape(blob_tablename)} "
+                f"WHERE id IN (SELECT id FROM {table} WHERE {where})",
+                params,
+            )
+        cursor = conn.execute(f"DELETE FROM {table} WHERE {where}", params)
+    return cursor.rowcount
+
+
+@contextlib.contextmanager
 def transaction():
     # Connections function as context managers which create transactions.
     # See: https://docs.python.org/3/library/sqlite3.html#using-the-connection-as-a-context-manager
     # We're relying here on the fact that because of the lru_cache,
     # `get_connection` actually returns the same connection instance every time
+    conn = get_write_connection()
+    depth = getattr(TRANSACTION_STATE, "depth", 0)
+    TRANSACTION_STATE.depth = depth + 1
+    try:
+        if conn.in_transaction:
+            # Within `batched_writes` (or another transaction) we use a
+            # savepoint so that an error only rolls back the writes made in
+            # this block, and nothing gets committed until the outer
+            # transaction is
+            conn.execute("SAVEPOINT nested_transaction")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK TO nested_transaction")
+                conn.execute("RELEASE nested_transaction")
+                raise
+            else:
+                conn.execute("RELEASE nested_transaction")
+        else:
+            # Taking the write lock up front means we never have to upgrade a
+            # read to a write part way through, which in WAL mode fails
+            # immediately (rather than waiting) if anyone else has written since
+            # our read began
+            conn.execute("BEGIN IMMEDIATE")
+            with conn:
+                yield conn
+    finally:
+        TRANSACTION_STATE.depth = depth
+
+
+@contextlib.contextmanager
+def batched_writes():
+    """
+    Within this context all writes made by the current thread go into a single
+    transaction, so a batch of small updates costs a single commit. The
+    transaction is committed when the context exits, even if an exception is
+    raised: each `transaction` block within it either completes or is rolled
+    back as normal, so what ends up in the database is exactly what would have
+    been there without batching. Use `flush_writes` to commit early.
+
+    The transaction only begins with the first write (see `get_write_connection`)
+    so reads made before then don't hold open a snapshot of the database.
+    """
     conn = get_connection()
-    conn.execute("BEGIN")
-    return conn
+    assert not conn.in_transaction
+    assert not getattr(TRANSACTION_STATE, "batching", False)
+    TRANSACTION_STATE.batching = True
+    try:
+        yield
+    finally:
+        TRANSACTION_STATE.batching = False
+        if conn.in_transaction:
+            conn.execute("COMMIT")
+
+
+def flush_writes():
+    """
+    Commit everything written so far within `batched_writes`, releasing the
+    write lock. Call this before doing anything slow, e.g. talking to Docker.
+    The next write begins a new transaction.
+
+    Outside of `batched_writes` this does nothing as writes are committed
+    immediately anyway. It also does nothing inside a `transaction` block, as
+    committing there would commit just part of that block's writes; they get
+    committed when the outermost block exits.
+    """
+    if getattr(TRANSACTION_STATE, "depth", 0):
+        return
+    conn = get_connection()
+    if conn.in_transaction:
+        conn.execute("COMMIT")
+
+
+@contextlib.contextmanager
+def read_only():
+    """
+    Within this context, all database access in the current thread goes
+    through a separate read-only connection. This is for code which only ever
+    reads, so it can't accidentally take a write lock, and any attempt to write
+    raises an error.
+    """
+    previous = getattr(READ_ONLY, "enabled", False)
+    READ_ONLY.enabled = True
+    try:
+        yield
+    finally:
+        READ_ONLY.enabled = previous
 
 
 def get_connection():
+    if getattr(READ_ONLY, "enabled", False):
+        return get_read_only_connection()
+    return get_read_write_connection()
+
+
+def get_write_connection():
+    """
+    Return the connection to use for writing, first beginning the transaction
+    for the current `batched_writes` batch if it hasn't begun already
+    """
+    conn = get_connection()
+    if getattr(TRANSACTION_STATE, "batching", False) and not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    return conn
+
+
+def get_read_write_connection():
     # The caching below means we get the same connection to the database every
     # time which is done not so much for efficiency as so that we can easily
     # implement transaction support without having to explicitly pass round a
@@ -109,6 +469,27 @@ def get_connection():
         return connection
 
 
+def get_read_only_connection():
+    filename = config.DATABASE_FILE
+    # In-memory databases can't be shared between connections so we have no
+    # choice but to use the read-write connection
+    if str(filename).startswith(":memory:"):
+        return get_read_write_connection()
+    cache = CONNECTION_CACHE.__dict__
+    key = (filename, "read_only")
+    if key in cache:
+        return cache[key]
+    # Make sure the database file exists and has an up-to-date schema, which
+    # we can't do over a read-only connection
+    get_read_write_connection()
+    uri = Path(filename).resolve().as_uri() + "?mode=ro"
+    connection = sqlite3.connect(uri, uri=True)
+    connection.isolation_level = None
+    connection.row_factory = sqlite3.Row
+    cache[key] = connection
+    return connection
+
+
 def get_connection_from_file(filename):
     if str(filename).startswith(":memory:"):
         filename = ":memory:"
@@ -121,11 +502,17 @@ def get_connection_from_file(filename):
     conn.isolation_level = None
     # Support dict-like access to rows
     conn.row_factory = sqlite3.Row
-    schema_count = list(conn.execute("SELECT COUNT(*) FROM sqlite_master"))[0][0]
-    if schema_count == 0:
-        with open(Path(__file__).parent / "schema.sql") as f:
-            schema_sql = f.read()
-        conn.executescript(schema_sql)
+    # Allow free pages to be returned to the filesystem a few at a time (see
+    # `jobrunner.maintenance`). This can only be set on a new database (existing
+    # ones need a one-off `python -m jobrunner.maintenance --full-vacuum`) and
+    # setting it takes the write lock, so we don't touch existing databases.
+    if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # The schema is written to be idempotent so we apply it every time which
+    # means that new tables and indexes get added to existing databases
+    with open(Path(__file__).parent / "schema.sql") as f:
+        schema_sql = f.read()
+    conn.executescript(schema_sql)
     return conn
 
 
@@ -133,31 +520,58 @@ def query_params_to_sql(params):
     """
     Turn a dict of query parameters into a pair of (SQL string, SQL values).
     All parameters are implicitly ANDed together, and there's a bit of magic to
-    handle `field__in=list_of_values` queries, LIKE queries and Enum classes.
+    handle `field__in=list_of_values` queries, LIKE queries, `field__lt=value`
+    and `field__gt=value` queries, `field__startswith=prefix` queries and Enum
+    classes.
+
+    Enum values are written directly into the SQL as literals rather than
+    passed as parameters. They come from a small fixed set so this is safe, and
+    it means that queries like `state__in=[State.PENDING, State.RUNNING]` can
+    make use of the partial indexes defined in `schema.sql` (SQLite can only
+    match a partial index's WHERE clause against literal values, not bound
+    parameters).
     """
     parts = []
     values = []
     for key, value in params.items():
         if key.endswith("__in"):
             field = key[:-4]
-            placeholders = ", ".join(["?"] * len(value))
+            placeholders = ", ".join(placeholder(v, values) for v in value)
             parts.append(f"{escape(field)} IN ({placeholders})")
-            values.extend(value)
         elif key.endswith("__like"):
             field = key[:-6]
-            parts.append(f"{escape(field)} LIKE ?")
-            values.append(value)
+            parts.append(f"{escape(field)} LIKE {placeholder(value, values)}")
+        elif key.endswith("__startswith"):
+            # We implement this as a range query rather than using LIKE as
+            # SQLite can only use an index for LIKE in restricted circumstances
+            field = key[:-12]
+            lower = placeholder(value, values)
+            upper = placeholder(value + MAX_CHAR, values)
+            parts.append(f"{escape(field)} >= {lower} AND {escape(field)} < {upper}")
+        elif key.endswith("__lt"):
+            field = key[:-4]
+            parts.append(f"{escape(field)} < {placeholder(value, values)}")
+        elif key.endswith("__gt"):
+            field = key[:-4]
+            parts.append(f"{escape(field)} > {placeholder(value, values)}")
         else:
-            parts.append(f"{escape(key)} = ?")
-            values.append(value)
-    # Bit of a hack: convert any Enum instances to their values so we can use
-    # them in querying
-    values = [v.value if isinstance(v, Enum) else v for v in values]
+            parts.append(f"{escape(key)} = {placeholder(value, values)}")
     if not parts:
         parts = ["1 = 1"]
     return " AND ".join(parts), values
 
 
+def placeholder(value, values):
+    """
+    Return the SQL fragment to use for `value` in a query, appending it to the
+    list of query parameters if it needs to be bound
+    """
+    if isinstance(value, Enum):
+        return quote(value.value)
+    values.append(value)
+    return "?"
+
+
 def escape(s):
     """
     Escape SQLite identifier (as opposed to string literal)
@@ -166,6 +580,13 @@ def escape(s):
     return '"{}"'.format(s.replace('"', '""'))
 
 
+def quote(s):
+    """
+    Quote SQLite string literal
+    """
+    return "'{}'".format(s.replace("'", "''"))
+
+
 def encode_field_values(fields, item):
     """
     Takes a list of dataclass fields and a dataclass instance and returns the
@@ -192,8 +613,11 @@ def decode_field_values(fields, row):
     values = []
     for field in fields:
         value = row[field.name]
+        # Large dicts and lists are stored elsewhere and need loading separately
+        if field.type in (list, dict) and value == COMPRESSED_MARKER:
+            value = NOT_LOADED
         # Dicts and lists get decoded from JSON
-        if field.type in (list, dict) and value is not None:
+        elif field.type in (list, dict) and value is not None:
             value = json.loads(value)
         # Enums get transformed back from their string/int values
         elif issubclass(field.type, Enum) and value is not None:
@@ -0,0 +1,115 @@
+"""
+Ops utility for finding jobs given a partial job ID, a job slug or an action
+name
+
+This is used by `kill_job` and `retry_job` to work out which job the user
+means. All lookups use indexed queries so they stay fast however many jobs
+we've run.
+"""
+import argparse
+import itertools
+
+from .database import iter_where, read_only
+from .models import Job
+from .string_utils import slugify
+
+
+# Maximum number of jobs to return (the most recent are returned first)
+MAX_MATCHES = 20
+
+
+def main(search_term, include_history=False):
+    jobs = find_jobs(search_term, include_history=include_history)
+    if not jobs:
+        print(f"No jobs found matching '{search_term}'")
+    for job in jobs:
+        print(f"{job.slug}  {job.state.value}  {job.created_at_isoformat}")
+
+
+def find_jobs(search_term, include_history=False):
+    """
+    Return all jobs matching `search_term`, which can be:
+
+     * a prefix of the job ID;
+     * the job's slug, or a prefix of it which includes at least the full
+       action name (slugs end with the job ID so, for instance, a slug with a
+       truncated ID will match);
+     * the name of the job's action.
+
+    At most `MAX_MATCHES` jobs are returned, most recent first.
+    """
+    search_term = search_term.strip()
+    term = search_term.lower()
+    if not term:
+        return []
+    # Job IDs never contain dashes but slugs always end with the ID preceded by
+    # a dash, so the final component of the search term is potentially (part
+    # of) an ID. An empty ID prefix would match every job so we don't bother.
+    jobs = []
+    slug_prefix, _, id_prefix = search_term.rpartition("-")
+    id_prefix = id_prefix.lower()
+    if id_prefix:
+        query_params = {"id__startswith": id_prefix}
+        if slug_prefix:
+            # Everything before the ID must end with the action name, which lets
+            # us rule out most jobs sharing a short ID prefix in the query
+            query_params["action__in"] = get_possible_action_names(slug_prefix)
+        jobs = search(term, include_history, **query_params)
+    if not jobs:
+        action_names = get_possible_action_names(search_term.rstrip("-"))
+        jobs = search(term, include_history, action__in=action_names)
+    return jobs
+
+
+def search(term, include_history, **query_params):
+    # Not every job the query returns necessarily matches, so we apply the limit
+    # afterwards rather than in the query
+    with read_only():
+        jobs = iter_where(
+            Job,
+            include_history=include_history,
+            order_by="-created_at",
+            **query_params,
+        )
+        return list(
+            itertools.islice((job for job in jobs if matches(job, term)), MAX_MATCHES)
+        )
+
+
+def matches(job, term):
+    if "-" not in term and job.id.startswith(term):
+        return True
+    if job.slug.startswith(term):
+        return True
+    # Compare slugified forms so that "run_model" and "run-model" both match
+    return slugify(job.action or "") == slugify(term)
+
+
+def get_possible_action_names(search_term):
+    """
+    Slugs contain the action name with underscores replaced by dashes, and
+    preceded by the project name, so if we've been given a slug (or a prefix of
+    one) we don't know exactly where the action name starts or which dashes
+    should be underscores. Instead we return all the action names it might
+    contain.
+    """
+    names = {search_term}
+    parts = search_term.lower().split("-")
+    for i in range(len(parts)):
+        names.add("-".join(parts[i:]))
+        names.add("_".join(parts[i:]))
+    return sorted(names)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n\n")[0])
+    parser.add_argument(
+        "search_term", help="Job ID prefix, job slug (or prefix) or action name"
+    )
+    parser.add_argument(
+        "--include-history",
+        action="store_true",
+        help="Also search jobs which have been archived",
+    )
+    args = parser.parse_args()
+    main(**vars(args))
@@ -3,8 +3,8 @@ Ops utility for killing jobs and cleaning up containers and volumes
 """
 import argparse
 
-from .database import find_where
-from .models import Job, State
+from .find_jobs import find_jobs
+from .models import State
 from .run import mark_job_as_failed
 from .manage_jobs import docker, container_name, volume_name
 
@@ -27,7 +27,7 @@ def get_jobs(partial_job_ids):
     jobs = []
     need_confirmation = False
     for partial_job_id in partial_job_ids:
-        matches = find_where(Job, id__like=f"%{partial_job_id}%")
+        matches = find_jobs(partial_job_id)
         if len(matches) == 0:
             raise RuntimeError(f"No jobs found matching '{partial_job_id}'")
         elif len(matches) > 1:
@@ -58,7 +58,9 @@ if __name__ == "__main__":
         help="Delete any associated containers and volumes",
     )
     parser.add_argument(
-        "partial_job_ids", nargs="+", help="ID of the job (or substring of the ID)"
+        "partial_job_ids",
+        nargs="+",
+        help="ID of the job (or prefix of the ID, or slug, or action name)",
     )
     args = parser.parse_args()
     main(**vars(args))
@@ -0,0 +1,144 @@
+"""
+Ops utility for reporting where jobs spend their time
+
+This uses the `job_event` log to work out, for each combination of backend,
+Docker image and action, how long jobs spent queued (i.e. between being
+created and starting to run) and how long they spent in each phase of their
+lifecycle (waiting on dependencies, waiting for workers, preparing, running,
+extracting outputs and so on).
+"""
+import argparse
+import json
+import math
+import shlex
+import time
+
+from .database import iter_where, read_only
+from .models import Job, JobEvent, State
+
+
+PERCENTILES = [50, 90, 99]
+
+QUEUED = "Queued"
+
+# Batch size for looking up job details (SQLite has a limit on the number of
+# parameters in a query)
+BATCH_SIZE = 500
+
+
+def main(days=None, output_json=False):
+    since = int(time.time() - days * 24 * 60 * 60) if days is not None else None
+    stats = get_latency_stats(since=since)
+    if output_json:
+        print(json.dumps(stats, indent=2))
+    else:
+        print(format_latency_stats(stats))
+
+
+def get_latency_stats(since=None):
+    """
+    Return a list of dicts, one for each combination of backend, image, action
+    and phase, giving the count, percentiles and maximum of the time (in
+    seconds) jobs spent in that phase
+    """
+    with read_only():
+        durations = get_phase_durations(since=since)
+    stats = []
+    for (backend, image, action, phase), values in sorted(durations.items()):
+        values = sorted(values)
+        row = dict(
+            backend=backend, image=image, action=action, phase=phase, count=len(values)
+        )
+        for pct in PERCENTILES:
+            row[f"p{pct}"] = percentile(values, pct)
+        row["max"] = values[-1]
+        stats.append(row)
+    return stats
+
+
+def get_phase_durations(since=None):
+    """
+    Return a dict mapping (backend, image, action, phase) to a list of
+    durations (in seconds)
+    """
+    query = {} if since is None else {"timestamp__gt": since}
+    # Each event marks the start of a phase which lasts until the job's next
+    # event. Terminal events don't start a phase so we don't need to track
+    # those.
+    phase_starts = {}
+    phase_durations = {}
+    backends = {}
+    for event in iter_where(JobEvent, order_by="timestamp", **query):
+        previous = phase_starts.pop(event.job_id, None)
+        if previous is not None:
+            phase_durations.setdefault(event.job_id, []).append(
+                (previous.status_message, event.timestamp - previous.timestamp)
+            )
+        if event.state in (State.PENDING, State.RUNNING):
+            phase_starts[event.job_id] = event
+        backends[event.job_id] = event.backend
+
+    durations = {}
+    for job in get_jobs(list(backends.keys())):
+        key = (backends[job.id], get_image(job.run_command), job.action)
+        if job.started_at is not None and job.created_at is not None:
+            queued = job.started_at - job.created_at
+            durations.setdefault(key + (QUEUED,), []).append(queued)
+        for phase, duration in phase_durations.get(job.id, []):
+            durations.setdefault(key + (phase,), []).append(duration)
+    return durations
+
+
+def get_jobs(job_ids):
+    columns = ["id", "action", "run_command", "created_at", "started_at"]
+    for i in range(0, len(job_ids), BATCH_SIZE):
+        yield from iter_where(
+            Job,
+            columns=columns,
+            include_history=True,
+            id__in=job_ids[i : i + BATCH_SIZE],
+        )
+
+
+def get_image(run_command):
+    if not run_command:
+        return ""
+    image = shlex.split(run_command)[0]
+    return image.split(":")[0]
+
+
+def percentile(sorted_values, pct):
+    """
+    Nearest-rank percentile of a pre-sorted list
+    """
+    index = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def format_latency_stats(stats):
+    headers = ["backend", "image", "action", "phase", "count"]
+    headers.extend(f"p{pct}" for pct in PERCENTILES)
+    headers.append("max")
+    rows = [headers] + [[str(row[header]) for header in headers] for row in stats]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(headers))]
+    return "\n".join(
+        "  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
+        for row in rows
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n\n")[0])
+    parser.add_argument(
+        "--days",
+        type=float,
+        help="Only include events from the last N days (default: all)",
+    )
+    parser.add_argument(
+        "--json",
+        dest="output_json",
+        action="store_true",
+        help="Output as JSON rather than as a table",
+    )
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,137 @@
+"""
+Periodic housekeeping for the job-runner database
+
+Each run:
+
+ * runs `PRAGMA optimize` so SQLite's query planner statistics stay up to
+   date as the data changes;
+ * returns free pages to the filesystem using incremental vacuum, a slice at a
+   time, so we never hold the write lock for long enough to stall the run
+   loop;
+ * runs `PRAGMA quick_check` on the live database. This goes through a
+   read-only connection and, as the database is in WAL mode, doesn't block
+   writers.
+
+Archiving old jobs is left to `archive_jobs.py`.
+"""
+import argparse
+import logging
+import time
+
+from . import config
+from .database import get_connection, read_only
+from .log_utils import configure_logging
+
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    log.info(f"Running database maintenance every {config.MAINTENANCE_INTERVAL}s")
+    while True:
+        time.sleep(config.MAINTENANCE_INTERVAL)
+        run_maintenance()
+
+
+def run_maintenance():
+    start = time.time()
+    size_before = get_database_size()
+    optimize()
+    vacuumed_pages = incremental_vacuum()
+    errors = quick_check()
+    reclaimed = size_before - get_database_size()
+    log.info(
+        f"Database maintenance finished in {time.time() - start:.1f}s: "
+        f"freed {vacuumed_pages} pages, reclaimed {reclaimed} bytes"
+    )
+    if errors:
+        log.error("Database integrity check failed:\n" + "\n".join(errors))
+    return dict(
+        vacuumed_pages=vacuumed_pages,
+        reclaimed=reclaimed,
+        errors=errors,
+    )
+
+
+def optimize():
+    conn = get_connection()
+    # Limit the number of rows ANALYZE looks at so this stays fast however big
+    # the database gets. The 0x10002 mask tells SQLite to consider every table,
+    # not just those used by queries on this connection.
+    conn.execute("PRAGMA analysis_limit = 1000")
+    conn.execute("PRAGMA optimize(0x10002)")
+
+
+def incremental_vacuum():
+    """
+    Return free pages to the filesystem a slice at a time, returning the total
+    number of pages freed
+    """
+    conn = get_connection()
+    if get_pragma(conn, "auto_vacuum") != 2:
+        log.info(
+            "Incremental vacuum not enabled on this database, run with "
+            "--full-vacuum to enable it"
+        )
+        return 0
+    freed = 0
+    while True:
+        free_pages = get_pragma(conn, "freelist_count")
+        if not free_pages:
+            break
+        pages = min(free_pages, config.MAINTENANCE_VACUUM_PAGES)
+        # `incremental_vacuum` returns a row per page so we need to consume the
+        # results for it to do its work
+        list(conn.execute(f"PRAGMA incremental_vacuum({pages:d})"))
+        freed += pages
+        time.sleep(config.MAINTENANCE_SLICE_SLEEP)
+    return freed
+
+
+def full_vacuum():
+    """
+    Rebuild the whole database, enabling incremental vacuum if it isn't already.
+    This blocks all writers for its duration so shouldn't be run while the
+    job-runner is busy.
+    """
+    conn = get_connection()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+def quick_check():
+    """
+    Return a list of any problems found with the database
+    """
+    with read_only():
+        conn = get_connection()
+        results = [row[0] for row in conn.execute("PRAGMA quick_check")]
+    if results == ["ok"]:
+        return []
+    return results
+
+
+def get_database_size():
+    conn = get_connection()
+    return get_pragma(conn, "page_count") * get_pragma(conn, "page_size")
+
+
+def get_pragma(conn, name):
+    return conn.execute(f"PRAGMA {name}").fetchone()[0]
+
+
+if __name__ == "__main__":
+    configure_logging()
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n\n")[0])
+    parser.add_argument(
+        "--full-vacuum",
+        action="store_true",
+        help=(
+            "Rebuild the entire database, enabling incremental vacuum (this "
+            "blocks the job-runner while it runs)"
+        ),
+    )
+    args = parser.parse_args()
+    if args.full_vacuum:
+        full_vacuum()
+    run_maintenance()
@@ -35,6 +35,30 @@ class StatusCode(Enum):
     NONZERO_EXIT = "nonzero_exit"
 
 
+class LazyField:
+    """
+    Descriptor for dataclass fields whose value may not have been loaded from
+    the database yet, see `Job.set_lazy_value`. The field defaults to None.
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        # Accessed on the class, which is how dataclasses finds the default
+        if instance is None:
+            return None
+        if self.name not in instance.__dict__:
+            loader = instance.__dict__["_lazy_loaders"].pop(self.name)
+            # Loading a value doesn't make it dirty, so we store it directly
+            # rather than going through `Job.__setattr__`
+            instance.__dict__[self.name] = loader()
+        return instance.__dict__[self.name]
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+
 # This is our internal representation of a JobRequest which we pass around but
 # never save to the database (hence no __tablename__ attribute)
 @dataclasses.dataclass
@@ -66,6 +90,14 @@ class SavedJobRequest:
 @dataclasses.dataclass
 class Job:
     __tablename__ = "job"
+    # Jobs which have been finished for a while get moved here, see
+    # `archive_jobs.py`
+    __history_tablename__ = "job_history"
+    # Large values of these fields get compressed and stored in a separate
+    # table, and are only loaded when accessed. See
+    # `database.compress_values`.
+    __compressed_fields__ = ("output_spec", "outputs", "unmatched_outputs")
+    __blob_tablename__ = "job_blob"
 
     id: str = None
     job_request_id: str = None
@@ -93,14 +125,14 @@ class Job:
     run_command: str = None
     # The specification of what outputs this job expects to produce, as a bunch
     # of named glob patterns organised by privacy level
-    output_spec: dict = None
+    output_spec: dict = LazyField()
     # The outputs the job did produce matching the patterns above, as a mapping
     # of filenames to privacy levels
-    outputs: dict = None
+    outputs: dict = LazyField()
     # A list of the outputs the job produced which didn't match any of the
     # output patterns. This is only populated in the case that there are
     # unmatched output patterns, and is only used for debugging purposes.
-    unmatched_outputs: list = None
+    unmatched_outputs: list = LazyField()
     # Human readable string giving details about what's currently happening
     # with this job
     status_message: str = None
@@ -128,6 +160,25 @@ class Job:
             hash_token = base64.b32encode(hash_bytes[:10]).decode("ascii").lower()
             self.id = hash_token
 
+    def __setattr__(self, name, value):
+        # Keep track of which attributes have been assigned to since the job
+        # was last loaded from or written to the database so that
+        # `database.update` can write just the columns which have changed.
+        # Note that this doesn't detect in-place mutation of list or dict
+        # values, which must be re-assigned to be picked up.
+        self.__dict__.setdefault("_dirty_fields", set()).add(name)
+        self.__dict__.get("_lazy_loaders", {}).pop(name, None)
+        super().__setattr__(name, value)
+
+    def set_lazy_value(self, name, loader):
+        """
+        Arrange for the value of field `name` (which must be a `LazyField`) to
+        be fetched by calling `loader` the first time it's accessed
+        """
+        assert isinstance(type(self).__dict__.get(name), LazyField)
+        self.__dict__.pop(name, None)
+        self.__dict__.setdefault("_lazy_loaders", {})[name] = loader
+
     def asdict(self):
         data = dataclasses.asdict(self)
         for key, value in data.items():
@@ -173,6 +224,43 @@ class Job:
         return slugify(f"{self.project}-{self.action}-{self.id}")
 
 
+# Records that a job must wait for another job to finish before it can run.
+# These get created at the same time as the job itself, see
+# `create_or_update_jobs.recursively_add_jobs`
+@dataclasses.dataclass
+class JobDependency:
+    __tablename__ = "job_dependency"
+
+    job_id: str
+    depends_on_id: str
+
+
+# Records a change in a job's state or status message. These are only ever
+# inserted, never updated, so we have a full history of how each job
+# progressed.
+@dataclasses.dataclass
+class JobEvent:
+    __tablename__ = "job_event"
+
+    job_id: str
+    backend: str
+    state: State
+    status_message: str
+    status_code: StatusCode
+    timestamp: int
+
+
+# Records that a job has changed and the job-server needs to be told about it.
+# The `id` is assigned by the database so the order in which changes were made
+# is preserved.
+@dataclasses.dataclass
+class JobOutboxItem:
+    __tablename__ = "job_outbox"
+
+    id: int = None
+    job_id: str = None
+
+
 def timestamp_to_isoformat(ts):
     if ts is None:
         return None
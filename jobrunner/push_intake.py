@@ -0,0 +1,113 @@
+"""
+Optional HTTP listener which lets the job-server push JobRequests to us as soon
+as they're created, rather than waiting for us to poll for them
+
+It accepts POSTs to `/job-requests/` containing JobRequests in the same format
+as the job-server's `job-requests` endpoint returns (either a single JobRequest,
+a list of them, or a `{"results": [...]}` page), authenticated with the same
+token we use when talking to the job-server. These are queued for intake in the
+sync "pull" thread. Polling carries on as normal so nothing is lost if a push
+fails.
+
+Enable it by setting PUSH_INTAKE_PORT (and PUSH_INTAKE_HOST if it needs to
+listen on something other than localhost).
+"""
+import hmac
+import http.server
+import json
+import logging
+import zlib
+
+from . import config
+from .sync import job_request_from_remote_format, queue_job_requests
+
+
+log = logging.getLogger(__name__)
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+def main():
+    server = get_server(config.PUSH_INTAKE_HOST, config.PUSH_INTAKE_PORT)
+    log.info(
+        f"Listening for pushed JobRequests at: "
+        f"http://{config.PUSH_INTAKE_HOST}:{server.server_port}/job-requests/"
+    )
+    server.serve_forever()
+
+
+def get_server(host, port):
+    return http.server.ThreadingHTTPServer((host, port), PushIntakeHandler)
+
+
+class PushIntakeHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path.rstrip("/") != "/job-requests":
+            return self.respond(404, {"error": "Not found"})
+        if not is_authorized(self.headers.get("Authorization")):
+            return self.respond(401, {"error": "Invalid token"})
+        max_size = config.PUSH_INTAKE_MAX_BODY_SIZE
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self.respond(400, {"error": "Invalid Content-Length"})
+        if length > max_size:
+            return self.respond(413, {"error": "Request too large"})
+        try:
+            body = self.rfile.read(length)
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gunzip(body, max_size)
+            job_requests = parse_job_requests(json.loads(body))
+        except RequestTooLarge:
+            return self.respond(413, {"error": "Request too large"})
+        except (ValueError, KeyError, TypeError, OSError, zlib.error) as e:
+            return self.respond(400, {"error": f"Invalid JobRequest: {e!r}"})
+        queue_job_requests(job_requests)
+        self.respond(202, {"queued": len(job_requests)})
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def is_authorized(token):
+    if not token:
+        return False
+    return hmac.compare_digest(
+        token.encode("utf8"), config.JOB_SERVER_TOKEN.encode("utf8")
+    )
+
+
+def gunzip(data, max_size):
+    """
+    Decompress gzipped `data`, refusing to produce more than `max_size` bytes so
+    that a small request can't expand to fill all our memory
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    body = decompressor.decompress(data, max_size + 1)
+    if len(body) > max_size or decompressor.unconsumed_tail:
+        raise RequestTooLarge()
+    if not decompressor.eof:
+        raise ValueError("Incomplete gzip data")
+    return body
+
+
+def parse_job_requests(data):
+    if isinstance(data, dict) and "results" in data:
+        data = data["results"]
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        raise TypeError("Expected a JobRequest or a list of JobRequests")
+    return [job_request_from_remote_format(item) for item in data]
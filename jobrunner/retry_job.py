@@ -10,17 +10,17 @@ opportunity to fix the bug and try again without having to re-run the
 entire job.
 
 To do this we simply put the job back into the RUNNING state and let the
-jobrunner pick it up again. We also need to update the job-server when we do
-this so that it puts the job back in an "active" state and continues to ask for
-updates on it.
+jobrunner pick it up again. The job-server gets told about this in the usual
+way (see `sync.send_job_updates`) so that it puts the job back in an "active"
+state and continues to ask for updates on it.
 """
 import argparse
 import time
 
-from .sync import api_post, job_to_remote_format
-from .database import find_where, update
-from .models import Job, State
+from .find_jobs import find_jobs
+from .models import State
 from .manage_jobs import docker, container_name
+from .run import save_transition
 
 
 def main(partial_job_id):
@@ -34,23 +34,12 @@ def main(partial_job_id):
     job.updated_at = int(time.time())
     print("\nUpdating job in database:")
     print(job)
-    update(
-        job,
-        update_fields=[
-            "state",
-            "status_message",
-            "status_code",
-            "completed_at",
-            "updated_at",
-        ],
-    )
-    print("\nPOSTing update to job-server")
-    api_post("jobs", json=[job_to_remote_format(job)])
+    save_transition(job, job.updated_at)
     print("\nDone")
 
 
 def get_job(partial_job_id):
-    matches = find_where(Job, id__like=f"%{partial_job_id}%")
+    matches = find_jobs(partial_job_id)
     if len(matches) == 0:
         raise RuntimeError("No matching jobs found")
     elif len(matches) > 1:
@@ -71,6 +60,9 @@ def get_job(partial_job_id):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__.partition("\n\n")[0])
-    parser.add_argument("partial_job_id", help="ID of the job (or substring of the ID)")
+    parser.add_argument(
+        "partial_job_id",
+        help="ID of the job (or prefix of the ID, or slug, or action name)",
+    )
     args = parser.parse_args()
     main(**vars(args))
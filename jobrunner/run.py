@@ -10,8 +10,20 @@ import time
 
 from .log_utils import configure_logging, set_log_context
 from . import config
-from .database import find_where, count_where, update, select_values
-from .models import Job, State, StatusCode
+from .database import (
+    iter_where,
+    exists_where,
+    count_where,
+    update,
+    reload,
+    insert,
+    transaction,
+    batched_writes,
+    flush_writes,
+    get_connection,
+)
+from .models import Job, JobDependency, JobEvent, JobOutboxItem, State, StatusCode
+from .sync import notify_job_updates
 from .manage_jobs import (
     JobError,
     start_job,
@@ -26,6 +38,7 @@ log = logging.getLogger(__name__)
 
 def main(exit_when_done=False, raise_on_failure=False):
     log.info("jobrunner.run loop started")
+    record_missing_job_dependencies()
     while True:
         active_jobs = handle_jobs(raise_on_failure=raise_on_failure)
         if exit_when_done and len(active_jobs) == 0:
@@ -33,28 +46,64 @@ def main(exit_when_done=False, raise_on_failure=False):
         time.sleep(config.JOB_LOOP_INTERVAL)
 
 
+# The fields we need in order to decide what to do with an active job on each
+# tick of the loop. This lets us avoid loading (and decoding) the large JSON
+# fields like `output_spec` and `outputs` until we actually need to start or
+# finalise a job, at which point we reload the full job.
+ACTIVE_JOB_FIELDS = [
+    "id",
+    "job_request_id",
+    "state",
+    "repo_url",
+    "workspace",
+    "action",
+    "status_message",
+    "status_code",
+    "updated_at",
+]
+
+
 def handle_jobs(raise_on_failure=False):
-    active_jobs = find_where(Job, state__in=[State.PENDING, State.RUNNING])
-    for job in active_jobs:
-        # `set_log_context` ensures that all log messages triggered anywhere
-        # further down the stack will have `job` set on them
-        with set_log_context(job=job):
-            if job.state == State.PENDING:
-                handle_pending_job(job)
-            elif job.state == State.RUNNING:
-                handle_running_job(job)
-        if raise_on_failure and job.state == State.FAILED:
-            raise JobError("Job failed")
+    try:
+        return handle_active_jobs(raise_on_failure=raise_on_failure)
+    except BaseException:
+        # If anything went wrong part way through then our cached jobs may no
+        # longer match what's in the database so we start again from scratch
+        ACTIVE_JOB_CACHE.clear()
+        raise
+
+
+def handle_active_jobs(raise_on_failure=False):
+    active_jobs = get_active_jobs()
+    # Rather than checking the dependencies of each pending job individually
+    # we work out up front which ones are ready to start and which can never
+    # start
+    ready_job_ids, dependency_failed_job_ids = get_job_readiness(active_jobs)
+    # Most ticks just update a few status messages and timestamps so we commit
+    # these together rather than paying for a commit per job. Anything which
+    # needs to be durable before we act on it (state changes) gets flushed
+    # immediately, and we always flush before talking to Docker so that we
+    # never hold the write lock (and block the sync threads) while we wait.
+    with batched_writes():
+        for job in active_jobs:
+            # `set_log_context` ensures that all log messages triggered
+            # anywhere further down the stack will have `job` set on them
+            with set_log_context(job=job):
+                if job.state == State.PENDING:
+                    handle_pending_job(job, ready_job_ids, dependency_failed_job_ids)
+                elif job.state == State.RUNNING:
+                    handle_running_job(job)
+            if raise_on_failure and job.state == State.FAILED:
+                raise JobError("Job failed")
     return active_jobs
 
 
-def handle_pending_job(job):
-    awaited_states = get_states_of_awaited_jobs(job)
-    if State.FAILED in awaited_states:
+def handle_pending_job(job, ready_job_ids, dependency_failed_job_ids):
+    if job.id in dependency_failed_job_ids:
         mark_job_as_failed(
             job, "Not starting as dependency failed", code=StatusCode.DEPENDENCY_FAILED
         )
-    elif any(state != State.SUCCEEDED for state in awaited_states):
+    elif job.id not in ready_job_ids:
         set_message(
             job, "Waiting on dependencies", code=StatusCode.WAITING_ON_DEPENDENCIES
         )
@@ -66,9 +115,12 @@ def handle_pending_job(job):
         else:
             try:
                 set_message(job, "Preparing")
+                flush_writes()
+                reload(job)
                 start_job(job)
             except JobError as exception:
                 mark_job_as_failed(job, exception)
+                flush_writes()
                 cleanup_job(job)
             except Exception:
                 mark_job_as_failed(job, "Internal error when starting job")
@@ -78,11 +130,15 @@ def handle_pending_job(job):
 
 
 def handle_running_job(job):
+    # Checking on the job means talking to Docker, see `handle_active_jobs`
+    flush_writes()
     if job_still_running(job):
         set_message(job, "Running")
     else:
         try:
             set_message(job, "Finished, checking status and extracting outputs")
+            flush_writes()
+            reload(job)
             job = finalise_job(job)
             # We expect the job to be transitioned into its final state at this
             # point
@@ -93,6 +149,7 @@ def handle_running_job(job):
             # tag all job-runner volumes and containers with a specific label
             # we could leave them around for debugging purposes and have a
             # cronjob which cleans them up a few days after they've stopped.
+            flush_writes()
             cleanup_job(job)
         except Exception:
             mark_job_as_failed(job, "Internal error when finalising job")
@@ -104,14 +161,125 @@ def handle_running_job(job):
             raise
         else:
             mark_job_as_completed(job)
+            flush_writes()
             cleanup_job(job)
 
 
-def get_states_of_awaited_jobs(job):
-    job_ids = job.wait_for_job_ids
-    if not job_ids:
-        return []
-    return select_values(Job, "state", id__in=job_ids)
+# Almost every change to an active job is made by the run loop itself, to the
+# very `Job` instances it holds, so rather than reading them all back from the
+# database on every tick we keep them here. We only reload them when jobs have
+# been added or removed, or have changed state, e.g. the sync thread adding new
+# jobs or `kill_job` being run from the command line. This includes state
+# changes made by the run loop itself, but those are rare compared to ticks.
+ACTIVE_JOB_CACHE = {}
+
+
+def get_active_jobs():
+    cache = ACTIVE_JOB_CACHE
+    # We check the version before reading so that we can't miss a change made
+    # in between
+    key = (config.DATABASE_FILE, get_job_version())
+    if cache.get("key") != key:
+        cache.clear()
+        cache["key"] = key
+        cache["jobs"] = list(
+            iter_where(
+                Job,
+                columns=ACTIVE_JOB_FIELDS,
+                state__in=[State.PENDING, State.RUNNING],
+            )
+        )
+    else:
+        cache["jobs"] = [
+            job for job in cache["jobs"] if job.state in [State.PENDING, State.RUNNING]
+        ]
+    return cache["jobs"]
+
+
+def get_job_version():
+    """
+    Return a counter which changes whenever a job is added or removed, or
+    changes state (see the `job_version` triggers in `schema.sql`)
+    """
+    sql = "SELECT COALESCE(MAX(version), 0) FROM job_version"
+    return get_connection().execute(sql).fetchone()[0]
+
+
+def get_job_readiness(active_jobs):
+    """
+    Return the IDs of the pending jobs which are ready to run, and of those
+    which can never run because a dependency failed. These can only change when
+    some job changes state so, unless that's happened, we reuse the answer from
+    the previous tick.
+    """
+    states = {job.id: job.state for job in active_jobs}
+    cached = ACTIVE_JOB_CACHE.get("readiness")
+    if cached is not None and cached[0] == states:
+        return cached[1]
+    readiness = (
+        get_pending_job_ids_ready_to_run(),
+        get_pending_job_ids_with_failed_dependency(),
+    )
+    ACTIVE_JOB_CACHE["readiness"] = (states, readiness)
+    return readiness
+
+
+# In both the queries below the `state IN ('pending', 'running')` term is
+# redundant but allows SQLite to use the `idx_job__active_state` partial index
+# (see `schema.sql`)
+
+
+def get_pending_job_ids_ready_to_run():
+    """
+    Return the IDs of all pending jobs whose dependencies have all succeeded
+    """
+    sql = """
+        SELECT job.id FROM job
+        WHERE job.state IN ('pending', 'running') AND job.state = 'pending'
+        AND NOT EXISTS (
+            SELECT 1 FROM job_dependency
+            JOIN job AS dependency ON dependency.id = job_dependency.depends_on_id
+            WHERE job_dependency.job_id = job.id
+            AND dependency.state != 'succeeded'
+        )
+    """
+    return {row[0] for row in get_connection().execute(sql)}
+
+
+def get_pending_job_ids_with_failed_dependency():
+    """
+    Return the IDs of all pending jobs with at least one failed dependency
+    """
+    sql = """
+        SELECT DISTINCT job.id FROM job
+        JOIN job_dependency ON job_dependency.job_id = job.id
+        JOIN job AS dependency ON dependency.id = job_dependency.depends_on_id
+        WHERE job.state IN ('pending', 'running') AND job.state = 'pending'
+        AND dependency.state = 'failed'
+    """
+    return {row[0] for row in get_connection().execute(sql)}
+
+
+def record_missing_job_dependencies():
+    """
+    Jobs created before the `job_dependency` table existed only have their
+    dependencies recorded in `wait_for_job_ids` so we fill in any gaps here
+    """
+    pending_jobs = list(
+        iter_where(
+            Job,
+            columns=["id", "state", "wait_for_job_ids"],
+            state__in=[State.PENDING, State.RUNNING],
+        )
+    )
+    for job in pending_jobs:
+        if job.state != State.PENDING or not job.wait_for_job_ids:
+            continue
+        if exists_where(JobDependency, job_id=job.id):
+            continue
+        with transaction():
+            for wait_for_job_id in job.wait_for_job_ids:
+                insert(JobDependency(job_id=job.id, depends_on_id=wait_for_job_id))
 
 
 def mark_job_as_failed(job, error, code=None):
@@ -129,15 +297,18 @@ def mark_job_as_running(job):
 def mark_job_as_completed(job):
     # Completed means either SUCCEEDED or FAILED. We just save the job to the
     # database exactly as is with the exception of setting the completed at
-    # timestamp
+    # timestamp (only the fields changed by `finalise_job` actually get
+    # written)
     assert job.state in [State.SUCCEEDED, State.FAILED]
-    job.completed_at = int(time.time())
-    update(job)
+    job.completed_at = get_timestamp()
+    save_transition(job, job.completed_at)
+    flush_writes()
+    notify_job_updates()
     log.info(job.status_message, extra={"status_code": job.status_code})
 
 
 def set_state(job, state, message, code=None):
-    timestamp = int(time.time())
+    timestamp = get_timestamp()
     if state == State.RUNNING:
         job.started_at = timestamp
     elif state == State.FAILED or state == State.SUCCEEDED:
@@ -146,35 +317,31 @@ def set_state(job, state, message, code=None):
     job.status_message = message
     job.status_code = code
     job.updated_at = timestamp
-    update(
-        job,
-        update_fields=[
-            "state",
-            "status_message",
-            "status_code",
-            "updated_at",
-            "started_at",
-            "completed_at",
-        ],
-    )
+    save_transition(job, timestamp)
+    # Changes of state are never batched up (see `handle_active_jobs`) as we
+    # may be about to act on them, e.g. by cleaning up the job's container
+    flush_writes()
+    notify_job_updates()
     log.info(job.status_message, extra={"status_code": job.status_code})
 
 
 def set_message(job, message, code=None):
-    timestamp = int(time.time())
+    timestamp = get_timestamp()
     # If message has changed then update and log
     if job.status_message != message:
         job.status_message = message
         job.status_code = code
         job.updated_at = timestamp
-        update(job, update_fields=["status_message", "status_code", "updated_at"])
+        save_transition(job, timestamp)
         log.info(job.status_message, extra={"status_code": job.status_code})
     # If the status message hasn't changed then we only update the timestamp
     # once a minute. This gives the user some confidence that the job is still
     # active without writing to the database every single time we poll
     elif timestamp - job.updated_at >= 60:
         job.updated_at = timestamp
-        update(job, update_fields=["updated_at"])
+        with transaction():
+            update(job)
+            insert(JobOutboxItem(job_id=job.id))
         # For long running jobs we don't want to fill the logs up with "Job X
         # is still running" messages, but it is useful to have semi-regular
         # confirmations in the logs that it is still running. The below will
@@ -183,6 +350,33 @@ def set_message(job, message, code=None):
             log.info(job.status_message, extra={"status_code": job.status_code})
 
 
+def save_transition(job, timestamp):
+    """
+    Save changes to the job's state or status message along with an event
+    recording the transition (see `latency_report.py`) and an entry in the
+    outbox so the job-server gets told about it (see `sync.send_job_updates`)
+    """
+    with transaction():
+        update(job)
+        insert(JobOutboxItem(job_id=job.id))
+        insert(
+            JobEvent(
+                job_id=job.id,
+                backend=config.BACKEND,
+                state=job.state,
+                status_message=job.status_message,
+                status_code=job.status_code,
+                timestamp=timestamp,
+            )
+        )
+
+
+def get_timestamp():
+    # All the timestamps we record against jobs come from here, which gives
+    # tests a single place to control them
+    return int(time.time())
+
+
 def job_running_capacity_available():
     running_jobs = count_where(Job, state=State.RUNNING)
     return running_jobs < config.MAX_WORKERS
@@ -1,13 +1,23 @@
 -- See jobrunner/models.py for comments on the fields here
+--
+-- This file is applied every time we open a connection so every statement
+-- must be idempotent (hence all the `IF NOT EXISTS` clauses). This gives us a
+-- very lightweight form of migrations: new tables and indexes get added to
+-- existing databases automatically.
 
-CREATE TABLE job_request (
+-- In write-ahead log mode readers never block writers (and vice versa) so
+-- long reads in the sync thread or ops utilities can't hold up the run loop.
+-- This setting is persistent and is ignored for in-memory databases.
+PRAGMA journal_mode = WAL;
+
+CREATE TABLE IF NOT EXISTS job_request (
     id TEXT,
     original TEXT,
 
     PRIMARY KEY (id)
 );
 
-CREATE TABLE job (
+CREATE TABLE IF NOT EXISTS job (
     id TEXT,
     job_request_id TEXT,
     state TEXT,
@@ -32,11 +42,138 @@ CREATE TABLE job (
     PRIMARY KEY (id)
 );
 
-CREATE INDEX idx_job__job_request_id ON job (job_request_id);
+CREATE INDEX IF NOT EXISTS idx_job__job_request_id ON job (job_request_id);
 
 -- Once jobs transition into a terminal state (failed or succeeded) they become
 -- basically irrelevant from the application's point of view as it never needs
 -- to query them. By creating an index only on non-terminal states we ensure
 -- that it always stays relatively small even as the set of historical jobs
 -- grows.
-CREATE INDEX idx_job__state ON job (state) WHERE state NOT IN ('failed', 'succeeded');
+--
+-- This replaces an earlier `idx_job__state` index whose WHERE clause was
+-- written as `state NOT IN ('failed', 'succeeded')`. SQLite never used that
+-- index because our queries are written as `state IN ('pending', 'running')`
+-- and it can only use a partial index where the query contains a term which
+-- is textually identical to the index's WHERE clause.
+DROP INDEX IF EXISTS idx_job__state;
+CREATE INDEX IF NOT EXISTS idx_job__active_state ON job (state) WHERE state IN ('pending', 'running');
+
+-- Used by `create_or_update_jobs.recursively_add_jobs` to check whether there
+-- is already an active job for a given action in a workspace. As above, the
+-- WHERE clause must match the SQL generated by `database.query_params_to_sql`
+-- for `state__in=[State.PENDING, State.RUNNING]` exactly.
+CREATE INDEX IF NOT EXISTS idx_job__workspace_action ON job (workspace, action) WHERE state IN ('pending', 'running');
+
+-- Used by `find_jobs` to look up jobs by action name in the ops utilities
+CREATE INDEX IF NOT EXISTS idx_job__action_created_at ON job (action, created_at);
+
+-- Large values of the `output_spec`, `outputs` and `unmatched_outputs` fields
+-- get compressed and stored here rather than in the `job` table (which just
+-- contains a marker value) so that the rows in the `job` table stay small.
+-- See `database.compress_values`. Entries are removed when their job is
+-- archived (the history table holds the values uncompressed) or deleted.
+CREATE TABLE IF NOT EXISTS job_blob (
+    id TEXT,
+    field TEXT,
+    data BLOB,
+
+    PRIMARY KEY (id, field)
+);
+
+-- Jobs which have been in a terminal state for longer than the retention
+-- period get moved here by `jobrunner.archive_jobs`. This keeps the `job`
+-- table small (and hence fast to query) however large the history gets. It
+-- has exactly the same shape as the `job` table.
+CREATE TABLE IF NOT EXISTS job_history (
+    id TEXT,
+    job_request_id TEXT,
+    state TEXT,
+    repo_url TEXT,
+    "commit" TEXT,
+    workspace TEXT,
+    database_name TEXT,
+    action TEXT,
+    requires_outputs_from TEXT,
+    wait_for_job_ids TEXT,
+    run_command TEXT,
+    output_spec TEXT,
+    outputs TEXT,
+    unmatched_outputs TEXT,
+    status_message TEXT,
+    status_code TEXT,
+    created_at INT,
+    updated_at INT,
+    started_at INT,
+    completed_at INT,
+
+    PRIMARY KEY (id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_job_history__job_request_id ON job_history (job_request_id);
+
+-- Records which jobs each job needs to wait for before it can run. This
+-- duplicates the `wait_for_job_ids` field on `job` but in a form which lets
+-- the run loop find which pending jobs are ready to run (or can never run)
+-- with a couple of indexed queries rather than checking each job in turn.
+CREATE TABLE IF NOT EXISTS job_dependency (
+    job_id TEXT,
+    depends_on_id TEXT,
+
+    PRIMARY KEY (job_id, depends_on_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_job_dependency__depends_on_id ON job_dependency (depends_on_id);
+
+-- Append-only log of every state and status message change for every job.
+-- Unlike the `job` table, which only has the latest state, this lets us work
+-- out how long jobs spend in each phase (see `jobrunner.latency_report`).
+CREATE TABLE IF NOT EXISTS job_event (
+    job_id TEXT,
+    backend TEXT,
+    state TEXT,
+    status_message TEXT,
+    status_code TEXT,
+    timestamp INT
+);
+
+CREATE INDEX IF NOT EXISTS idx_job_event__job_id_timestamp ON job_event (job_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_job_event__timestamp ON job_event (timestamp);
+
+-- Jobs whose latest state still needs sending to the job-server. A row is
+-- added in the same transaction as each change to a job and only removed once
+-- the job-server has accepted the update, so updates survive job-server
+-- outages and restarts (see `sync.send_job_updates`).
+CREATE TABLE IF NOT EXISTS job_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT
+);
+
+-- A counter which goes up whenever a job is added or removed, or changes
+-- state. The run loop uses this to tell when it needs to reload its cached
+-- set of active jobs (see `run.get_active_jobs`). Unlike SQLite's
+-- `data_version` it isn't affected by writes to other tables, like the
+-- outbox. The single row is only created by the first change to a job, as
+-- anything here which writes would make opening every connection a write.
+CREATE TABLE IF NOT EXISTS job_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INT
+);
+
+CREATE TRIGGER IF NOT EXISTS job_version__insert AFTER INSERT ON job
+BEGIN
+    INSERT OR REPLACE INTO job_version (id, version)
+    VALUES (1, COALESCE((SELECT version FROM job_version), 0) + 1);
+END;
+
+CREATE TRIGGER IF NOT EXISTS job_version__delete AFTER DELETE ON job
+BEGIN
+    INSERT OR REPLACE INTO job_version (id, version)
+    VALUES (1, COALESCE((SELECT version FROM job_version), 0) + 1);
+END;
+
+CREATE TRIGGER IF NOT EXISTS job_version__update_state AFTER UPDATE OF state ON job
+WHEN OLD.state IS NOT NEW.state
+BEGIN
+    INSERT OR REPLACE INTO job_version (id, version)
+    VALUES (1, COALESCE((SELECT version FROM job_version), 0) + 1);
+END;
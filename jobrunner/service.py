@@ -7,6 +7,9 @@ import threading
 
 from . import config
 from .log_utils import configure_logging
+from . import backup
+from . import maintenance
+from . import push_intake
 from . import run
 from . import sync
 
@@ -15,39 +18,70 @@ log = logging.getLogger(__name__)
 
 
 def main():
-    """Run the main run loop after starting the sync loop in a thread."""
-    # extra space to align with other thread's "sync" label.
+    """Run the main run loop after starting the sync loops in threads."""
+    # extra space to align with the other threads' "pull" and "push" labels
     threading.current_thread().name = "run "
     fmt = "{asctime} {threadName} {message} {tags}"
     configure_logging(fmt)
 
     try:
         log.info("jobrunner.service started")
-        # daemon=True means this thread will be automatically join()ed when the
-        # process exits
-        thread = threading.Thread(target=sync_wrapper, daemon=True)
-        thread.name = "sync"
-        thread.start()
+        # daemon=True means these threads will be automatically join()ed when
+        # the process exits. Intake and status reporting run independently so
+        # that problems with one don't hold up the other.
+        for scheduler in sync.get_schedulers():
+            thread = threading.Thread(target=scheduler.run_forever, daemon=True)
+            thread.name = scheduler.name
+            thread.start()
+        if config.PUSH_INTAKE_PORT:
+            intake_thread = threading.Thread(target=push_intake_wrapper, daemon=True)
+            intake_thread.name = "recv"
+            intake_thread.start()
+        if config.BACKUP_INTERVAL:
+            backup_thread = threading.Thread(target=backup_wrapper, daemon=True)
+            backup_thread.name = "backup"
+            backup_thread.start()
+        if config.MAINTENANCE_INTERVAL:
+            maintenance_thread = threading.Thread(
+                target=maintenance_wrapper, daemon=True
+            )
+            maintenance_thread.name = "maintenance"
+            maintenance_thread.start()
         run.main()
     except KeyboardInterrupt:
         log.info("jobrunner.service stopped")
 
 
-def sync_wrapper():
-    """Wrap the sync call with logging context and an exception handler."""
-    # avoid busy retries on hard failure
-    sleep_after_error = config.POLL_INTERVAL * 5
+def push_intake_wrapper():
+    """Wrap the push intake listener with an exception handler."""
     while True:
         try:
-            sync.main()
-        except sync.SyncAPIError as e:
-            # Handle these separately as we don't want the full traceback here,
-            # just the text of the error response
-            log.error(e)
-            time.sleep(sleep_after_error)
+            push_intake.main()
         except Exception:
-            log.exception("Exception in sync thread")
-            time.sleep(sleep_after_error)
+            log.exception("Exception in push intake thread")
+            time.sleep(config.POLL_INTERVAL * 5)
+
+
+def backup_wrapper():
+    """Wrap the backup loop with an exception handler."""
+    while True:
+        # No need to sleep after an error as `backup.main` waits for
+        # BACKUP_INTERVAL before taking its first backup
+        try:
+            backup.main()
+        except Exception:
+            log.exception("Exception in backup thread")
+
+
+def maintenance_wrapper():
+    """Wrap the maintenance loop with an exception handler."""
+    while True:
+        # As with backups, `maintenance.main` waits before its first run so
+        # there's no need to sleep here
+        try:
+            maintenance.main()
+        except Exception:
+            log.exception("Exception in maintenance thread")
 
 
 if __name__ == "__main__":
@@ -1,23 +1,56 @@
 """
 Script which polls the job-server endpoint for active JobRequests and POSTs
-back any associated Jobs.
+back any changes to their Jobs.
+
+These are two independent loops (see `Scheduler`), each with its own interval
+and backoff, so that slow git fetches during intake don't hold up status
+updates and errors POSTing status updates don't stop intake.
 """
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import json
 import logging
+import queue
 import sys
+import threading
 import time
 
 import requests
 
 from .log_utils import configure_logging, set_log_context
 from . import config
-from .create_or_update_jobs import create_or_update_jobs
-from .database import find_where
-from .models import JobRequest, Job
+from .create_or_update_jobs import create_or_update_jobs, known_job_requests
+from .database import find_where, iter_where, delete_where, read_only
+from .models import JobRequest, Job, JobOutboxItem
 
 
 session = requests.Session()
 log = logging.getLogger(__name__)
 
+# The ETag and Last-Modified headers from the last set of JobRequests we
+# successfully handled, see `poll_job_requests`
+JOB_REQUESTS_VALIDATORS = {}
+
+# The IDs of the JobRequests which the job-server last told us were active
+ACTIVE_JOB_REQUEST_IDS = []
+
+# Bytes of request body sent to the job-server since we last logged it, and how
+# many that would have been without compression, see `send_request`
+BYTES_SENT = {"sent": 0, "uncompressed": 0}
+
+# Set when jobs have changed state and the job-server should be told about it
+# straight away, see `notify_job_updates`
+JOB_UPDATES_PENDING = threading.Event()
+
+# JobRequests pushed to us by the job-server (see `push_intake.py`) waiting to
+# be handled, and an event which gets set when any arrive
+PUSHED_JOB_REQUESTS = queue.Queue()
+JOB_REQUESTS_PUSHED = threading.Event()
+
+# Set by intake after a full refresh of the active JobRequests to tell status
+# reporting to POST all their jobs, see `report_job_updates`
+FULL_RESYNC_PENDING = threading.Event()
+
 
 class SyncAPIError(Exception):
     pass
@@ -28,34 +61,384 @@ def main():
         f"Polling for JobRequests at: "
         f"{config.JOB_SERVER_ENDPOINT.rstrip('/')}/job-requests/"
     )
-    while True:
-        sync()
-        time.sleep(config.POLL_INTERVAL)
+    intake, reporting = get_schedulers()
+    thread = threading.Thread(target=reporting.run_forever, daemon=True)
+    thread.name = reporting.name
+    thread.start()
+    intake.run_forever()
 
 
-def sync():
-    response = api_get(
-        "job-requests",
-        # We're deliberately not paginating here on the assumption that the set
-        # of active jobs is always going to be small enough that we can fetch
-        # them in a single request and we don't need the extra complexity
-        params={"backend": config.BACKEND},
+def get_schedulers():
+    intake = Scheduler(
+        "pull",
+        run_intake,
+        interval=config.POLL_INTERVAL,
+        full_interval=config.SYNC_FULL_RESYNC_INTERVAL,
+        wake=JOB_REQUESTS_PUSHED,
+        wake_func=handle_pushed_job_requests,
+        workers=config.SYNC_INTAKE_WORKERS,
+    )
+    reporting = Scheduler(
+        "push",
+        report_job_updates,
+        interval=config.SYNC_REPORT_INTERVAL,
+        wake=JOB_UPDATES_PENDING,
     )
-    job_requests = [job_request_from_remote_format(i) for i in response["results"]]
+    return intake, reporting
+
+
+class Scheduler:
+    """
+    Calls `func` every `interval` seconds
 
-    # Bail early if there's nothing to do
-    if not job_requests:
+    If `full_interval` is given then `func` is called with `full_resync=True`
+    on the first call and then at least that many seconds apart. If `wake` (a
+    `threading.Event`) is given then setting it triggers a call straight away,
+    either of `func` or, if supplied, of `wake_func` (in which case `func`
+    still gets called on its usual schedule).
+
+    If `workers` is given then the scheduler keeps a pool of that many threads
+    for the lifetime of `run_forever` and passes it to `func` and `wake_func` as
+    `executor`. Keeping the threads (and hence their database connections)
+    around saves starting new ones on every call.
+
+    After an error we back off exponentially, up to SYNC_MAX_BACKOFF, ignoring
+    any wake-ups for `func` in the meantime. Each scheduler keeps its own counts
+    of calls and errors so we can see how each one is doing.
+    """
+
+    # How many runs of `func` between each log of the scheduler's metrics
+    metrics_log_interval = 100
+
+    def __init__(
+        self,
+        name,
+        func,
+        interval,
+        full_interval=None,
+        wake=None,
+        wake_func=None,
+        workers=None,
+    ):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.full_interval = full_interval
+        self.wake = wake
+        self.wake_func = wake_func
+        self.executor = None
+        if workers:
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix=name
+            )
+        self.stopped = threading.Event()
+        self.last_full_resync = None
+        self.calls = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.last_success = None
+        self.last_duration = None
+
+    def run_forever(self):
+        runs = 0
+        try:
+            while not self.stopped.is_set():
+                deadline = time.time() + self.run_once()
+                runs += 1
+                if runs % self.metrics_log_interval == 0:
+                    self.log_metrics()
+                while self.wait(deadline - time.time()):
+                    if self.wake_func is None:
+                        break
+                    self.call(self.wake_func)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+    def stop(self):
+        """
+        Make `run_forever` return once any call in progress has finished
+        """
+        self.stopped.set()
+        if self.wake is not None:
+            self.wake.set()
+
+    def run_once(self):
+        """
+        Call `func` and return how long to wait before calling it again
+        """
+        if self.full_interval is None:
+            succeeded = self.call(self.func)
+        else:
+            full_resync = self.full_resync_due()
+            succeeded = self.call(self.func, full_resync=full_resync)
+            if succeeded and full_resync:
+                self.last_full_resync = time.time()
+        if not succeeded:
+            return self.get_backoff()
+        return self.interval
+
+    def call(self, func, **kwargs):
+        if self.executor is not None:
+            kwargs["executor"] = self.executor
+        start = time.time()
+        self.calls += 1
+        try:
+            func(**kwargs)
+        except Exception as e:
+            self.errors += 1
+            self.consecutive_errors += 1
+            if isinstance(e, SyncAPIError):
+                # We don't want the full traceback here, just the text of the
+                # error response
+                log.error(e)
+            else:
+                log.exception(f"Exception in {self.name} loop")
+            return False
+        finally:
+            self.last_duration = time.time() - start
+        if self.consecutive_errors:
+            log.info(f"Recovered after {self.consecutive_errors} errors")
+        self.consecutive_errors = 0
+        self.last_success = time.time()
+        return True
+
+    def full_resync_due(self):
+        return (
+            self.last_full_resync is None
+            or time.time() - self.last_full_resync >= self.full_interval
+        )
+
+    def get_backoff(self):
+        # Nothing gets lost by waiting (e.g. updates stay in the outbox until
+        # they're accepted) and there's no point hammering a job-server which
+        # is struggling
+        backoff = self.interval * 2 ** self.consecutive_errors
+        return min(backoff, config.SYNC_MAX_BACKOFF)
+
+    def wait(self, timeout):
+        """
+        Wait for `timeout` seconds, returning True if woken before then
+        """
+        if self.wake is None:
+            self.stopped.wait(timeout=max(timeout, 0))
+            return False
+        deadline = time.time() + timeout
+        while self.wake.wait(timeout=max(deadline - time.time(), 0)):
+            if self.stopped.is_set():
+                return False
+            if self.consecutive_errors == 0 or self.wake_func is not None:
+                # Give anything else which happens at around the same time
+                # (e.g. other jobs changing state in the same tick of the run
+                # loop) the chance to go in the same batch
+                time.sleep(config.SYNC_PUSH_DELAY)
+                self.wake.clear()
+                return True
+            self.wake.clear()
+        return False
+
+    def metrics(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "consecutive_errors": self.consecutive_errors,
+            "last_success": self.last_success,
+            "last_duration": self.last_duration,
+        }
+
+    def log_metrics(self):
+        metrics = " ".join(f"{k}={v}" for k, v in self.metrics().items())
+        log.info(f"{self.name} loop metrics: {metrics}")
+
+
+def notify_job_updates():
+    """
+    Tell status reporting there are job updates it should send straight away,
+    rather than waiting for its next scheduled run. Should only be called once
+    the changes have been committed.
+    """
+    JOB_UPDATES_PENDING.set()
+
+
+def sync(full_resync=False):
+    """
+    Do a single round of both intake and status reporting
+    """
+    run_intake(full_resync=full_resync)
+    report_job_updates()
+
+
+def run_intake(full_resync=False, executor=None):
+    handle_pushed_job_requests(executor=executor)
+    poll_job_requests(full_resync=full_resync, executor=executor)
+
+
+def queue_job_requests(job_requests):
+    """
+    Queue JobRequests pushed to us by the job-server to be handled by intake
+    straight away
+    """
+    for job_request in job_requests:
+        PUSHED_JOB_REQUESTS.put(job_request)
+    JOB_REQUESTS_PUSHED.set()
+
+
+def handle_pushed_job_requests(executor=None):
+    job_requests = []
+    while True:
+        try:
+            job_requests.append(PUSHED_JOB_REQUESTS.get_nowait())
+        except queue.Empty:
+            break
+    if job_requests:
+        log.info(f"Handling {len(job_requests)} pushed JobRequests")
+        # If this fails we don't bother re-queueing anything as we'll get the
+        # same JobRequests again when we next poll
+        handle_job_requests(job_requests, executor=executor)
+        notify_job_updates()
+
+
+def poll_job_requests(full_resync=False, executor=None):
+    # Most of the time the set of active JobRequests is exactly the same as it
+    # was on the previous poll, so we ask the job-server to just tell us if
+    # that's the case. On a full resync we fetch them regardless, which also
+    # protects against ever getting stuck with a bad cached response.
+    validators = {} if full_resync else JOB_REQUESTS_VALIDATORS
+    response, new_validators = api_get_if_changed(
+        "job-requests", validators, params={"backend": config.BACKEND}
+    )
+    if response is None:
+        log.debug("JobRequests unchanged since last poll")
         return
+    # Normally there's just a single page of results, but after an outage
+    # there can be a large backlog so we handle each page as it arrives. That
+    # keeps memory use bounded and means jobs start (and the job-server hears
+    # about them) without waiting for the whole backlog to be fetched.
+    job_request_ids = []
+    page_count = 0
+    hits, misses = known_job_requests.hits, known_job_requests.misses
+    while True:
+        page_count += 1
+        job_requests = [job_request_from_remote_format(i) for i in response["results"]]
+        handle_job_requests(job_requests, executor=executor)
+        job_request_ids.extend(job_request.id for job_request in job_requests)
+        notify_job_updates()
+        next_url = response.get("next")
+        if not next_url:
+            break
+        response, _ = api_get_if_changed(next_url, {})
+    # Only remember the response once we've successfully handled it, otherwise
+    # a failure part way through would never get retried. The validators only
+    # apply to the first page so we can't rely on them if there was more than
+    # one.
+    JOB_REQUESTS_VALIDATORS.clear()
+    if page_count == 1:
+        JOB_REQUESTS_VALIDATORS.update(new_validators)
+    ACTIVE_JOB_REQUEST_IDS[:] = job_request_ids
+    if full_resync:
+        FULL_RESYNC_PENDING.set()
+    log.info(
+        f"Handled {len(job_request_ids)} JobRequests in {page_count} pages "
+        f"(known JobRequests: {known_job_requests.hits - hits} hits, "
+        f"{known_job_requests.misses - misses} misses)"
+    )
+
+
+def report_job_updates():
+    send_job_updates()
+    if FULL_RESYNC_PENDING.is_set():
+        FULL_RESYNC_PENDING.clear()
+        try:
+            send_all_jobs(list(ACTIVE_JOB_REQUEST_IDS))
+        except Exception:
+            FULL_RESYNC_PENDING.set()
+            raise
+    log_bytes_sent()
+
+
+def handle_job_requests(job_requests, executor=None):
+    """
+    Create jobs for any new JobRequests
 
-    job_request_ids = [i.id for i in job_requests]
+    This can involve fetching code from GitHub which can be slow, so we work on
+    several JobRequests at once, using `executor`, to stop one slow repo holding
+    up everyone else. JobRequests for the same repo are handled one at a time,
+    in the order we received them, as they share a local copy of the repo.
+
+    The intake scheduler supplies a long-lived executor, otherwise (e.g. for a
+    one-off `sync`) we start one just for these JobRequests.
+    """
+    if executor is None:
+        with ThreadPoolExecutor(
+            max_workers=config.SYNC_INTAKE_WORKERS, thread_name_prefix="pull"
+        ) as executor:
+            return handle_job_requests(job_requests, executor=executor)
+    job_requests_by_repo = {}
+    for job_request in job_requests:
+        job_requests_by_repo.setdefault(job_request.repo_url, []).append(job_request)
+    futures = [
+        executor.submit(handle_job_requests_for_repo, repo_job_requests)
+        for repo_job_requests in job_requests_by_repo.values()
+    ]
+    # Re-raise any unexpected errors (`create_or_update_jobs` handles all the
+    # expected ones itself)
+    for future in futures:
+        future.result()
+
+
+def handle_job_requests_for_repo(job_requests):
     for job_request in job_requests:
         with set_log_context(job_request=job_request):
             create_or_update_jobs(job_request)
-    jobs = find_where(Job, job_request_id__in=job_request_ids)
-    jobs_data = [job_to_remote_format(i) for i in jobs]
-    log.debug(f"Syncing {len(jobs_data)} jobs back to job-server")
 
-    api_post("jobs", json=jobs_data)
+
+def send_job_updates():
+    """
+    POST any jobs which have changed to the job-server
+
+    Every change to a job adds an entry to the outbox in the same transaction
+    (see `run.save_transition`), so we work through the outbox in order and
+    only remove entries once the job-server has accepted them. If the same job
+    appears more than once in a batch we just send its current state.
+    """
+    while True:
+        items = list(
+            iter_where(JobOutboxItem, order_by="id", limit=config.SYNC_BATCH_SIZE)
+        )
+        if not items:
+            break
+        job_ids = list(dict.fromkeys(item.job_id for item in items))
+        # Use a read-only connection as this can be a large read and we never
+        # want it to hold up the run loop
+        with read_only():
+            jobs = find_where(Job, include_history=True, id__in=job_ids)
+        jobs_by_id = {job.id: job for job in jobs}
+        jobs_data = [
+            job_to_remote_format(jobs_by_id[i]) for i in job_ids if i in jobs_by_id
+        ]
+        log.debug(f"Syncing {len(jobs_data)} jobs back to job-server")
+        if jobs_data:
+            api_post("jobs", json=jobs_data)
+        delete_where(JobOutboxItem, id__in=[item.id for item in items])
+        if len(items) < config.SYNC_BATCH_SIZE:
+            break
+
+
+def send_all_jobs(job_request_ids):
+    """
+    POST every job belonging to the supplied JobRequests, whether or not it has
+    changed
+    """
+    if not job_request_ids:
+        return
+    # Use a read-only connection as this can be a large read and we never
+    # want it to hold up the run loop
+    with read_only():
+        jobs = find_where(Job, job_request_id__in=job_request_ids)
+    log.debug(f"Resyncing all {len(jobs)} active jobs with job-server")
+    for i in range(0, len(jobs), config.SYNC_BATCH_SIZE):
+        batch = jobs[i : i + config.SYNC_BATCH_SIZE]
+        api_post("jobs", json=[job_to_remote_format(job) for job in batch])
 
 
 def api_get(*args, **kwargs):
@@ -66,12 +449,47 @@ def api_post(*args, **kwargs):
     return api_request("post", *args, **kwargs)
 
 
+def api_get_if_changed(path, validators, **kwargs):
+    """
+    Make a conditional GET request using the validators (ETag and Last-Modified
+    headers) from a previous response. Returns a tuple of the decoded response
+    and its validators, or `None` and the original validators if the response
+    hasn't changed.
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    response = send_request("get", path, headers=headers, **kwargs)
+    if response.status_code == 304:
+        return None, validators
+    new_validators = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+    return response.json(), new_validators
+
+
 def api_request(method, path, *args, **kwargs):
-    url = "{}/{}/".format(config.JOB_SERVER_ENDPOINT.rstrip("/"), path.strip("/"))
+    return send_request(method, path, *args, **kwargs).json()
+
+
+def send_request(method, path, *args, headers=None, **kwargs):
+    url = get_url(path)
     # We could do this just once on import, but it makes changing the config in
     # tests more fiddly
-    session.headers = {"Authorization": config.JOB_SERVER_TOKEN}
-    response = session.request(method, url, *args, **kwargs)
+    session.headers = {
+        "Authorization": config.JOB_SERVER_TOKEN,
+        # `requests` transparently decompresses the response for us
+        "Accept-Encoding": "gzip",
+    }
+    headers = dict(headers or {})
+    post_data = kwargs.pop("json", None)
+    if post_data is not None:
+        headers["Content-Type"] = "application/json"
+        kwargs["data"] = encode_body(post_data, headers)
+    response = session.request(method, url, *args, headers=headers, **kwargs)
 
     log.debug(
         "%s %s %s post_data=%s %s"
@@ -79,7 +497,7 @@ def api_request(method, path, *args, **kwargs):
             method.upper(),
             response.status_code,
             url,
-            kwargs.get("json", '""'),
+            post_data if post_data is not None else '""',
             response.text,
         )
     )
@@ -89,7 +507,45 @@ def api_request(method, path, *args, **kwargs):
     except Exception as e:
         raise SyncAPIError(e) from e
 
-    return response.json()
+    return response
+
+
+def get_url(path):
+    endpoint = config.JOB_SERVER_ENDPOINT.rstrip("/")
+    if path.startswith(("http://", "https://")):
+        # This is a link from a previous response (e.g. to the next page of
+        # results) which we only want to follow, and send our token to, if it
+        # points at the job-server
+        if not path.startswith(endpoint + "/"):
+            raise SyncAPIError(f"Refusing to follow link outside job-server: {path}")
+        return path
+    return "{}/{}/".format(endpoint, path.strip("/"))
+
+
+def encode_body(data, headers):
+    """
+    Encode `data` as JSON, gzipping it if it's large enough to be worth it (in
+    which case we set the appropriate header)
+    """
+    body = json.dumps(data).encode("utf8")
+    uncompressed_size = len(body)
+    threshold = config.SYNC_COMPRESSION_THRESHOLD
+    if threshold and uncompressed_size >= threshold:
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = "gzip"
+    BYTES_SENT["sent"] += len(body)
+    BYTES_SENT["uncompressed"] += uncompressed_size
+    return body
+
+
+def log_bytes_sent():
+    sent, uncompressed = BYTES_SENT["sent"], BYTES_SENT["uncompressed"]
+    if sent:
+        log.info(
+            f"Sent {sent} bytes to job-server "
+            f"({uncompressed} uncompressed, ratio {uncompressed / sent:.1f})"
+        )
+    BYTES_SENT.update(sent=0, uncompressed=0)
 
 
 def job_request_from_remote_format(job_request):
@@ -22,6 +22,7 @@ def tmp_work_dir(monkeypatch, tmp_path):
         "HIGH_PRIVACY_WORKSPACES_DIR",
         "MEDIUM_PRIVACY_WORKSPACES_DIR",
         "JOB_LOG_DIR",
+        "BACKUP_DIR",
     ]
     for config_var in config_vars:
         monkeypatch.setattr(
@@ -0,0 +1,30 @@
+import time
+
+from jobrunner.archive_jobs import archive_jobs
+from jobrunner.database import insert, find_where, exists_where
+from jobrunner.models import Job, State
+
+
+DAY = 24 * 60 * 60
+
+
+def test_archive_jobs(tmp_work_dir):
+    now = int(time.time())
+    insert(Job(id="old_success", state=State.SUCCEEDED, completed_at=now - 40 * DAY))
+    insert(Job(id="old_failure", state=State.FAILED, completed_at=now - 40 * DAY))
+    insert(Job(id="new_success", state=State.SUCCEEDED, completed_at=now - 1 * DAY))
+    insert(Job(id="running", state=State.RUNNING))
+    assert archive_jobs(days=30) == 2
+    assert sorted(job.id for job in find_where(Job)) == ["new_success", "running"]
+    archived = find_where(Job, include_history=True, id__in=["old_success"])
+    assert archived[0].state == State.SUCCEEDED
+    assert exists_where(Job, include_history=True, id="old_failure")
+    assert not exists_where(Job, id="old_failure")
+
+
+def test_archive_jobs_ignores_jobs_being_waited_on(tmp_work_dir):
+    now = int(time.time())
+    insert(Job(id="old_success", state=State.SUCCEEDED, completed_at=now - 40 * DAY))
+    insert(Job(id="pending", state=State.PENDING, wait_for_job_ids=["old_success"]))
+    assert archive_jobs(days=30) == 0
+    assert exists_where(Job, id="old_success")
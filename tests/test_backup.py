@@ -0,0 +1,83 @@
+import sqlite3
+import threading
+
+import pytest
+
+from jobrunner import backup, config
+from jobrunner.backup import backup_database, delete_incomplete_backups
+from jobrunner.database import insert
+from jobrunner.models import Job, State
+
+
+def test_backup_database(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr("jobrunner.config.BACKUP_PAGES_PER_STEP", 1)
+    monkeypatch.setattr("jobrunner.config.BACKUP_STEP_SLEEP", 0)
+    for i in range(50):
+        insert(Job(id=f"job{i}", state=State.PENDING, output_spec={"x": "y" * 1000}))
+    backup_file = backup_database()
+    conn = sqlite3.connect(str(backup_file))
+    assert conn.execute("SELECT COUNT(*) FROM job").fetchone()[0] == 50
+    assert list(config.BACKUP_DIR.glob("*.tmp")) == []
+
+
+def test_backup_database_while_writing(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr("jobrunner.config.BACKUP_PAGES_PER_STEP", 1)
+    monkeypatch.setattr("jobrunner.config.BACKUP_STEP_SLEEP", 0.001)
+    for i in range(50):
+        insert(Job(id=f"job{i}", state=State.PENDING, output_spec={"x": "y" * 1000}))
+    done = threading.Event()
+    written = []
+
+    def write():
+        while not done.is_set():
+            insert(Job(id=f"new{len(written)}", state=State.PENDING))
+            written.append(1)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    try:
+        written_before = len(written)
+        backup_file = backup_database()
+        written_during = len(written) - written_before
+    finally:
+        done.set()
+        thread.join()
+    # Writes during the backup neither stop it finishing nor end up in it
+    # half-done
+    assert written_during > 0
+    conn = sqlite3.connect(str(backup_file))
+    assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    assert conn.execute("SELECT COUNT(*) FROM job").fetchone()[0] >= 50
+
+
+def test_old_backups_are_deleted(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr("jobrunner.config.BACKUP_COUNT", 2)
+    config.BACKUP_DIR.mkdir(parents=True)
+    for name in ["db-20200101-000000.sqlite", "db-20200102-000000.sqlite"]:
+        (config.BACKUP_DIR / name).touch()
+    insert(Job(id="foo"))
+    latest = backup_database()
+    backups = sorted(config.BACKUP_DIR.glob("*.sqlite"))
+    assert backups == [config.BACKUP_DIR / "db-20200102-000000.sqlite", latest]
+
+
+def test_failed_backup_leaves_nothing_behind(tmp_work_dir, monkeypatch):
+    def copy_database(source_file, destination_file, pages, step_sleep=0):
+        assert pages > 0
+        destination_file.write_bytes(b"partial")
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(backup, "copy_database", copy_database)
+    with pytest.raises(sqlite3.OperationalError):
+        backup_database()
+    assert list(config.BACKUP_DIR.iterdir()) == []
+
+
+def test_delete_incomplete_backups(tmp_work_dir):
+    config.BACKUP_DIR.mkdir(parents=True)
+    (config.BACKUP_DIR / "db-20200101-000000.sqlite").touch()
+    (config.BACKUP_DIR / "db-20200102-000000.sqlite.tmp").touch()
+    delete_incomplete_backups()
+    assert list(config.BACKUP_DIR.iterdir()) == [
+        config.BACKUP_DIR / "db-20200101-000000.sqlite"
+    ]
@@ -1,11 +1,15 @@
 from pathlib import Path
+from unittest.mock import Mock
 import uuid
 
-from jobrunner.database import find_where
-from jobrunner.models import JobRequest, Job, State
+from jobrunner import create_or_update_jobs as create_or_update_jobs_module
+from jobrunner.database import delete_where, find_where, insert
+from jobrunner.models import JobRequest, Job, JobDependency, State
 from jobrunner.create_or_update_jobs import (
+    KnownJobRequests,
     create_or_update_jobs,
     create_jobs_with_project_file,
+    related_jobs_exist,
 )
 
 
@@ -120,6 +124,11 @@ def test_adding_job_creates_dependencies(tmp_work_dir):
     assert prepare_1_job.wait_for_job_ids == [generate_job.id]
     assert prepare_2_job.wait_for_job_ids == [generate_job.id]
     assert generate_job.wait_for_job_ids == []
+    dependencies = find_where(JobDependency, job_id=analyse_job.id)
+    assert {d.depends_on_id for d in dependencies} == {
+        prepare_1_job.id,
+        prepare_2_job.id,
+    }
 
 
 def test_existing_active_jobs_are_picked_up_when_checking_dependencies(tmp_work_dir):
@@ -151,3 +160,33 @@ def make_job_request(action="generate_cohort", **kwargs):
     for key, value in kwargs.items():
         setattr(job_request, key, value)
     return job_request
+
+
+def test_known_job_requests(tmp_work_dir):
+    insert(Job(id="foo", job_request_id="123"))
+    known_job_requests = KnownJobRequests(max_size=2)
+    # Loaded from the database on first use
+    assert "123" in known_job_requests
+    assert "456" not in known_job_requests
+    known_job_requests.add("456")
+    known_job_requests.add("789")
+    # The least recently used ID gets forgotten
+    assert "123" not in known_job_requests
+    assert "456" in known_job_requests
+    assert (known_job_requests.hits, known_job_requests.misses) == (2, 2)
+
+
+def test_related_jobs_exist_uses_known_job_requests(tmp_work_dir, monkeypatch):
+    known_job_requests = KnownJobRequests(max_size=10)
+    monkeypatch.setattr(
+        create_or_update_jobs_module, "known_job_requests", known_job_requests
+    )
+    job_request = Mock(id="123")
+    assert not related_jobs_exist(job_request)
+    # Jobs added since we loaded the known IDs still get found
+    insert(Job(id="foo", job_request_id="123"))
+    assert related_jobs_exist(job_request)
+    # And after that we don't need to check the database
+    delete_where(Job, id="foo")
+    assert related_jobs_exist(job_request)
+    assert (known_job_requests.hits, known_job_requests.misses) == (1, 2)
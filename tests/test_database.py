@@ -1,4 +1,28 @@
-from jobrunner.database import insert, find_where, update, select_values
+import json
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from jobrunner.database import (
+    CONNECTION_CACHE,
+    insert,
+    find_where,
+    iter_where,
+    reload,
+    update,
+    select_values,
+    get_connection,
+    query_params_to_sql,
+    read_only,
+    transaction,
+    batched_writes,
+    flush_writes,
+    count_where,
+    archive_where,
+    delete_where,
+)
 from jobrunner.models import Job, State
 
 
@@ -32,3 +56,266 @@ def test_select_values(tmp_work_dir):
     assert sorted(values) == ["foo123", "foo125"]
     values = select_values(Job, "state", id="foo124")
     assert values == [State.RUNNING]
+
+
+def test_active_jobs_by_workspace_and_action_uses_index(tmp_work_dir):
+    plan = get_query_plan(
+        Job, workspace="1", action="foo", state__in=[State.PENDING, State.RUNNING]
+    )
+    assert "USING INDEX idx_job__workspace_action" in plan
+
+
+def test_jobs_by_workspace_and_action_without_state_filter_does_not_use_index(
+    tmp_work_dir,
+):
+    plan = get_query_plan(Job, workspace="1", action="foo")
+    assert "idx_job__workspace_action" not in plan
+
+
+def test_schema_is_applied_to_existing_database(tmp_work_dir):
+    conn = get_connection()
+    conn.execute("DROP INDEX idx_job__workspace_action")
+    conn.close()
+    CONNECTION_CACHE.__dict__.clear()
+    plan = get_query_plan(
+        Job, workspace="1", action="foo", state__in=[State.PENDING, State.RUNNING]
+    )
+    assert "USING INDEX idx_job__workspace_action" in plan
+
+
+def get_query_plan(itemclass, **query_params):
+    where, params = query_params_to_sql(query_params)
+    sql = f"SELECT * FROM {itemclass.__tablename__} WHERE {where}"
+    rows = get_connection().execute(f"EXPLAIN QUERY PLAN {sql}", params)
+    return "\n".join(row["detail"] for row in rows)
+
+
+def test_update_only_writes_changed_fields(tmp_work_dir):
+    insert(Job(id="foo123", action="foo", status_message="hello"))
+    job = find_where(Job, id="foo123")[0]
+    # Simulate another process changing a field we haven't touched
+    get_connection().execute("UPDATE job SET action = 'bar' WHERE id = 'foo123'")
+    job.status_message = "goodbye"
+    update(job)
+    job = find_where(Job, id="foo123")[0]
+    assert job.action == "bar"
+    assert job.status_message == "goodbye"
+
+
+def test_update_with_no_changes_is_a_noop(tmp_work_dir):
+    insert(Job(id="foo123", action="foo"))
+    job = find_where(Job, id="foo123")[0]
+    get_connection().execute("UPDATE job SET action = 'bar' WHERE id = 'foo123'")
+    update(job)
+    assert find_where(Job, id="foo123")[0].action == "bar"
+
+
+def test_iter_where(tmp_work_dir):
+    insert(Job(id="foo1", state=State.PENDING, created_at=3, output_spec={"a": 1}))
+    insert(Job(id="foo2", state=State.RUNNING, created_at=1))
+    insert(Job(id="foo3", state=State.FAILED, created_at=2))
+    jobs = list(
+        iter_where(
+            Job,
+            columns=["id", "state"],
+            order_by="-created_at",
+            limit=2,
+            state__in=[State.PENDING, State.FAILED],
+        )
+    )
+    assert [(job.id, job.state) for job in jobs] == [
+        ("foo1", State.PENDING),
+        ("foo3", State.FAILED),
+    ]
+    # Fields we didn't ask for aren't loaded
+    assert jobs[0].output_spec is None
+    assert jobs[0].created_at is None
+
+
+def test_updating_partially_loaded_item(tmp_work_dir):
+    insert(Job(id="foo1", action="foo", output_spec={"a": 1}))
+    job = next(iter_where(Job, columns=["id", "action"]))
+    job.action = "bar"
+    update(job)
+    reload(job)
+    assert job.action == "bar"
+    assert job.output_spec == {"a": 1}
+
+
+def test_read_only(tmp_work_dir):
+    insert(Job(id="foo123", action="foo"))
+    with read_only():
+        assert find_where(Job, id="foo123")[0].action == "foo"
+        with pytest.raises(sqlite3.OperationalError):
+            insert(Job(id="foo124"))
+    # Writes work again once we've left the read-only context
+    insert(Job(id="foo124"))
+
+
+def test_read_only_sees_latest_writes(tmp_work_dir):
+    with read_only():
+        assert find_where(Job) == []
+    insert(Job(id="foo123"))
+    with read_only():
+        assert [job.id for job in find_where(Job)] == ["foo123"]
+
+
+def test_new_connections_dont_wait_for_the_write_lock(tmp_work_dir):
+    insert(Job(id="foo123"))
+    results = []
+
+    def read():
+        start = time.time()
+        with read_only():
+            results.append(len(find_where(Job)))
+        results.append(time.time() - start)
+
+    with transaction():
+        update(Job(id="foo123", action="foo"))
+        # A new thread has to open new connections, which mustn't write
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+    assert results[0] == 1
+    assert results[1] < 1
+
+
+def test_large_values_are_compressed(tmp_work_dir):
+    outputs = {f"output/file_{i}.csv": "highly_sensitive" for i in range(1000)}
+    insert(Job(id="foo123", outputs=outputs, output_spec={"small": "value"}))
+    conn = get_connection()
+    row = conn.execute("SELECT outputs, output_spec FROM job").fetchone()
+    assert row["outputs"] == "compressed"
+    assert row["output_spec"] == '{"small": "value"}'
+    blob = conn.execute("SELECT data FROM job_blob WHERE id = 'foo123'").fetchone()
+    assert len(blob["data"]) < len(json.dumps(outputs))
+
+    job = find_where(Job, id="foo123")[0]
+    # Not loaded until accessed
+    assert "outputs" not in job.__dict__
+    assert job.outputs == outputs
+    assert "outputs" in job.__dict__
+    # Accessing the value doesn't mark it as changed
+    assert job._dirty_fields == set()
+
+
+def test_updating_compressed_values(tmp_work_dir):
+    outputs = {f"output/file_{i}.csv": "highly_sensitive" for i in range(1000)}
+    insert(Job(id="foo123", outputs=outputs))
+    job = find_where(Job, id="foo123")[0]
+    job.outputs = {"small": "value"}
+    update(job)
+    assert find_where(Job, id="foo123")[0].outputs == {"small": "value"}
+    assert get_connection().execute("SELECT * FROM job_blob").fetchall() == []
+    # Assigning a value before the original one is loaded replaces it
+    job = find_where(Job, id="foo123")[0]
+    job.outputs = outputs
+    update(job)
+    job = find_where(Job, id="foo123")[0]
+    job.outputs = {"other": "value"}
+    assert job.outputs == {"other": "value"}
+
+
+def test_failed_insert_leaves_existing_compressed_values_alone(tmp_work_dir):
+    outputs = {f"output/file_{i}.csv": "highly_sensitive" for i in range(1000)}
+    insert(Job(id="foo123", outputs=outputs))
+    with pytest.raises(sqlite3.IntegrityError):
+        insert(Job(id="foo123", outputs={**outputs, "other.csv": "x"}))
+    assert find_where(Job, id="foo123")[0].outputs == outputs
+
+
+def test_archiving_and_deleting_removes_compressed_values(tmp_work_dir):
+    outputs = {f"output/file_{i}.csv": "highly_sensitive" for i in range(1000)}
+    insert(Job(id="foo1", outputs=outputs))
+    insert(Job(id="foo2", outputs=outputs))
+    insert(Job(id="foo3", outputs=outputs))
+    archive_where(Job, id="foo1")
+    delete_where(Job, id="foo2")
+    conn = get_connection()
+    blob_ids = [row["id"] for row in conn.execute("SELECT id FROM job_blob")]
+    assert blob_ids == ["foo3"]
+    # The archived job's values are kept, in the history table itself
+    assert find_where(Job, include_history=True, id="foo1")[0].outputs == outputs
+
+
+def test_nested_transaction_only_rolls_back_inner_writes(tmp_work_dir):
+    with transaction():
+        insert(Job(id="foo1"))
+        with pytest.raises(ValueError):
+            with transaction():
+                insert(Job(id="foo2"))
+                raise ValueError()
+        insert(Job(id="foo3"))
+    assert {job.id for job in find_where(Job)} == {"foo1", "foo3"}
+
+
+def test_batched_writes(tmp_work_dir):
+    queries = []
+    conn = get_connection()
+    conn.set_trace_callback(queries.append)
+    try:
+        with batched_writes():
+            for i in range(3):
+                with transaction():
+                    insert(Job(id=f"foo{i}"))
+    finally:
+        conn.set_trace_callback(None)
+    assert queries.count("COMMIT") == 1
+    assert count_where(Job) == 3
+
+
+def test_batched_writes_are_committed_on_error(tmp_work_dir):
+    with pytest.raises(ValueError):
+        with batched_writes():
+            insert(Job(id="foo1"))
+            flush_writes()
+            insert(Job(id="foo2"))
+            raise ValueError()
+    # A separate connection sees everything written before the error
+    with read_only():
+        assert count_where(Job) == 2
+
+
+def test_flush_writes_never_commits_part_of_a_transaction(tmp_work_dir):
+    with batched_writes():
+        insert(Job(id="foo1"))
+        with transaction():
+            insert(Job(id="foo2"))
+            flush_writes()
+            with read_only():
+                assert count_where(Job) == 0
+        flush_writes()
+        with read_only():
+            assert count_where(Job) == 2
+
+
+def test_batched_writes_only_begin_with_first_write(tmp_work_dir):
+    queries = []
+    conn = get_connection()
+    conn.set_trace_callback(queries.append)
+    try:
+        with batched_writes():
+            count_where(Job)
+            assert not conn.in_transaction
+            flush_writes()
+            insert(Job(id="foo1"))
+            assert conn.in_transaction
+            flush_writes()
+            assert not conn.in_transaction
+            flush_writes()
+            assert queries.count("COMMIT") == 1
+    finally:
+        conn.set_trace_callback(None)
+
+
+def test_batched_writes_after_another_connection_commits(tmp_work_dir):
+    insert(Job(id="foo1"))
+    with batched_writes():
+        assert count_where(Job) == 1
+        # Another thread, with its own connection, writes in between our read
+        # and our write
+        thread = threading.Thread(target=insert, args=[Job(id="foo2")])
+        thread.start()
+        thread.join()
+        insert(Job(id="foo3"))
+        assert count_where(Job) == 3
@@ -0,0 +1,62 @@
+from jobrunner.database import insert, get_connection, read_only
+from jobrunner.find_jobs import find_jobs
+from jobrunner.models import Job, State
+
+
+def test_find_jobs(tmp_work_dir):
+    generate = add_job("generate_cohort", created_at=1)
+    model = add_job("run_model", created_at=2)
+    # An older job with the same action
+    old_model = add_job("run_model", created_at=0)
+
+    assert find_jobs(generate.id[:6]) == [generate]
+    assert find_jobs(generate.id.upper()) == [generate]
+    assert find_jobs(generate.slug) == [generate]
+    assert find_jobs(generate.slug[:-8]) == [generate]
+    assert find_jobs("run_model") == [model, old_model]
+    assert find_jobs("run-model") == [model, old_model]
+    assert find_jobs("my-project-run-model") == [model, old_model]
+    assert find_jobs("nosuchaction") == []
+    assert find_jobs("") == []
+
+
+def test_find_jobs_by_slug_with_short_id(tmp_work_dir):
+    job = add_job("generate_cohort", created_at=0, id="ab0000")
+    # Lots of newer jobs whose IDs start the same way
+    for i in range(30):
+        add_job("run_model", created_at=i + 1, id=f"ab{i:04}x")
+    assert find_jobs("my-project-generate-cohort-a") == [job]
+    assert find_jobs("my-project-generate-cohort-ab") == [job]
+    assert len(find_jobs("ab")) == 20
+    # An empty ID prefix isn't treated as matching every ID
+    assert find_jobs("my-project-generate-cohort-") == [job]
+
+
+def test_find_jobs_queries_use_indexes(tmp_work_dir):
+    add_job("generate_cohort", created_at=1)
+    queries = []
+    with read_only():
+        conn = get_connection()
+    conn.set_trace_callback(queries.append)
+    try:
+        find_jobs("my-project-generate-cohort-nomatch")
+    finally:
+        conn.set_trace_callback(None)
+    assert len(queries) == 2
+    for sql in queries:
+        rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}")
+        details = [row["detail"] for row in rows]
+        assert not any(detail.startswith("SCAN") for detail in details), details
+
+
+def add_job(action, created_at, **kwargs):
+    job = Job(
+        job_request_id=f"{action}-{created_at}",
+        action=action,
+        repo_url="https://github.com/opensafely/my-project",
+        state=State.SUCCEEDED,
+        created_at=created_at,
+        **kwargs,
+    )
+    insert(job)
+    return job
@@ -0,0 +1,56 @@
+from jobrunner import run
+from jobrunner.database import insert, find_where
+from jobrunner.latency_report import get_latency_stats, format_latency_stats
+from jobrunner.models import Job, JobEvent, State, StatusCode
+
+
+def test_get_latency_stats(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr("jobrunner.config.BACKEND", "tpp")
+    job = Job(
+        id="foo",
+        state=State.PENDING,
+        action="generate_cohort",
+        run_command="cohortextractor:latest generate_cohort",
+        created_at=1000,
+        updated_at=1000,
+    )
+    insert(job)
+    set_time(monkeypatch, 1010)
+    run.set_message(
+        job, "Waiting on dependencies", code=StatusCode.WAITING_ON_DEPENDENCIES
+    )
+    set_time(monkeypatch, 1030)
+    run.set_message(job, "Preparing")
+    set_time(monkeypatch, 1035)
+    run.mark_job_as_running(job)
+    # Unchanged messages shouldn't create new events
+    set_time(monkeypatch, 1040)
+    run.set_message(job, "Running")
+    set_time(monkeypatch, 1135)
+    run.mark_job_as_failed(job, "Oh no")
+
+    events = find_where(JobEvent, job_id="foo")
+    assert [e.state for e in events] == [
+        State.PENDING,
+        State.PENDING,
+        State.RUNNING,
+        State.FAILED,
+    ]
+    assert events[0].backend == "tpp"
+
+    stats = get_latency_stats()
+    durations = {row["phase"]: row["p50"] for row in stats}
+    assert durations == {
+        "Queued": 35,
+        "Waiting on dependencies": 20,
+        "Preparing": 5,
+        "Running": 100,
+    }
+    assert {(row["backend"], row["image"], row["action"]) for row in stats} == {
+        ("tpp", "cohortextractor", "generate_cohort")
+    }
+    assert "Waiting on dependencies" in format_latency_stats(stats)
+
+
+def set_time(monkeypatch, timestamp):
+    monkeypatch.setattr(run, "get_timestamp", lambda: timestamp)
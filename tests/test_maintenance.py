@@ -0,0 +1,65 @@
+import secrets
+
+from jobrunner import config
+from jobrunner.database import (
+    insert,
+    count_where,
+    delete_where,
+    get_connection,
+    get_connection_from_file,
+)
+from jobrunner.maintenance import (
+    run_maintenance,
+    full_vacuum,
+    get_pragma,
+    quick_check,
+)
+from jobrunner.models import Job, State
+
+
+def test_run_maintenance(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr("jobrunner.config.MAINTENANCE_SLICE_SLEEP", 0)
+    monkeypatch.setattr("jobrunner.config.MAINTENANCE_VACUUM_PAGES", 10)
+    for i in range(50):
+        # Random so that it doesn't compress down to nothing
+        outputs = {"x": secrets.token_hex(5000)}
+        insert(Job(id=f"job{i}", state=State.SUCCEEDED, outputs=outputs))
+    stats = run_maintenance()
+    assert stats["errors"] == []
+    # Maintenance never archives or deletes jobs itself
+    assert count_where(Job) == 50
+    # Create some free pages to reclaim
+    delete_where(Job)
+    stats = run_maintenance()
+    assert stats["vacuumed_pages"] > 0
+    assert stats["reclaimed"] > 0
+    assert stats["errors"] == []
+    assert get_pragma(get_connection(), "freelist_count") == 0
+
+
+def test_quick_check_uses_live_database(tmp_work_dir):
+    # A stale or broken backup mustn't affect the check
+    config.BACKUP_DIR.mkdir(parents=True)
+    (config.BACKUP_DIR / "db-20200101-000000.sqlite").write_bytes(b"not a database")
+    insert(Job(id="foo"))
+    assert quick_check() == []
+
+
+def test_full_vacuum_enables_incremental_vacuum(tmp_work_dir):
+    conn = get_connection()
+    conn.execute("PRAGMA auto_vacuum = NONE")
+    conn.execute("VACUUM")
+    assert get_pragma(conn, "auto_vacuum") == 0
+    full_vacuum()
+    assert get_pragma(conn, "auto_vacuum") == 2
+
+
+def test_auto_vacuum_only_set_on_new_databases(tmp_work_dir):
+    conn = get_connection()
+    assert get_pragma(conn, "auto_vacuum") == 2
+    conn.execute("PRAGMA auto_vacuum = NONE")
+    conn.execute("VACUUM")
+    # Opening another connection leaves the existing database alone
+    other_conn = get_connection_from_file(config.DATABASE_FILE)
+    assert get_pragma(other_conn, "auto_vacuum") == 0
+    other_conn.close()
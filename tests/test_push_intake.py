@@ -0,0 +1,112 @@
+import gzip
+import http.client
+import json
+import queue
+import threading
+
+import pytest
+import requests
+
+from jobrunner import config, push_intake, sync
+
+
+@pytest.fixture
+def intake_server(monkeypatch):
+    monkeypatch.setattr(config, "JOB_SERVER_TOKEN", "secret")
+    monkeypatch.setattr(sync, "PUSHED_JOB_REQUESTS", queue.Queue())
+    monkeypatch.setattr(sync, "JOB_REQUESTS_PUSHED", threading.Event())
+    server = push_intake.get_server("127.0.0.1", 0)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    )
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/job-requests/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_pushed_job_requests_are_queued(intake_server):
+    response = requests.post(
+        intake_server,
+        json={"results": [remote_job_request("123"), remote_job_request("456")]},
+        headers={"Authorization": "secret"},
+    )
+    assert response.status_code == 202
+    assert response.json() == {"queued": 2}
+    assert sync.JOB_REQUESTS_PUSHED.is_set()
+    queued = [sync.PUSHED_JOB_REQUESTS.get_nowait() for _ in range(2)]
+    assert [job_request.id for job_request in queued] == ["123", "456"]
+
+
+def test_pushed_job_requests_can_be_compressed(intake_server):
+    body = gzip.compress(json.dumps(remote_job_request("123")).encode())
+    response = requests.post(
+        intake_server,
+        data=body,
+        headers={"Authorization": "secret", "Content-Encoding": "gzip"},
+    )
+    assert response.status_code == 202
+    assert sync.PUSHED_JOB_REQUESTS.get_nowait().id == "123"
+
+
+@pytest.mark.parametrize("token", [None, "", "wrong"])
+def test_pushed_job_requests_need_valid_token(intake_server, token):
+    headers = {"Authorization": token} if token is not None else {}
+    response = requests.post(
+        intake_server, json=remote_job_request("123"), headers=headers
+    )
+    assert response.status_code == 401
+    assert sync.PUSHED_JOB_REQUESTS.empty()
+
+
+def test_invalid_job_requests_are_rejected(intake_server):
+    response = requests.post(
+        intake_server, json={"identifier": "123"}, headers={"Authorization": "secret"}
+    )
+    assert response.status_code == 400
+    assert sync.PUSHED_JOB_REQUESTS.empty()
+
+
+def test_invalid_content_length_is_rejected(intake_server):
+    host, port = intake_server.split("/")[2].split(":")
+    connection = http.client.HTTPConnection(host, int(port))
+    connection.putrequest("POST", "/job-requests/")
+    connection.putheader("Authorization", "secret")
+    connection.putheader("Content-Length", "-1")
+    connection.endheaders()
+    assert connection.getresponse().status == 400
+    connection.close()
+
+
+def test_large_requests_are_rejected(intake_server, monkeypatch):
+    monkeypatch.setattr(config, "PUSH_INTAKE_MAX_BODY_SIZE", 1000)
+    body = json.dumps([remote_job_request(str(i)) for i in range(10)]).encode()
+    response = requests.post(
+        intake_server, data=body, headers={"Authorization": "secret"}
+    )
+    assert response.status_code == 413
+    # Small when compressed, but too large once decompressed
+    assert len(gzip.compress(body)) < 1000
+    response = requests.post(
+        intake_server,
+        data=gzip.compress(body),
+        headers={"Authorization": "secret", "Content-Encoding": "gzip"},
+    )
+    assert response.status_code == 413
+    assert sync.PUSHED_JOB_REQUESTS.empty()
+
+
+def remote_job_request(identifier):
+    return {
+        "identifier": identifier,
+        "workspace": {
+            "name": "testing",
+            "repo": "https://github.com/opensafely/foo",
+            "branch": "master",
+            "db": "full",
+        },
+        "requested_actions": ["generate_cohort"],
+        "force_run_dependencies": False,
+    }
@@ -0,0 +1,168 @@
+import threading
+
+from jobrunner import config, run
+from jobrunner.database import (
+    delete_where,
+    find_where,
+    get_connection,
+    insert,
+    read_only,
+    update,
+)
+from jobrunner.models import Job, JobDependency, JobOutboxItem, State
+from jobrunner.run import (
+    get_pending_job_ids_ready_to_run,
+    get_pending_job_ids_with_failed_dependency,
+    record_missing_job_dependencies,
+)
+
+
+def test_pending_job_readiness(tmp_work_dir):
+    insert(Job(id="succeeded", state=State.SUCCEEDED))
+    insert(Job(id="failed", state=State.FAILED))
+    insert(Job(id="running", state=State.RUNNING))
+    add_job_with_dependencies("no_deps")
+    add_job_with_dependencies("deps_succeeded", "succeeded")
+    add_job_with_dependencies("deps_running", "succeeded", "running")
+    add_job_with_dependencies("deps_failed", "running", "failed")
+    assert get_pending_job_ids_ready_to_run() == {"no_deps", "deps_succeeded"}
+    assert get_pending_job_ids_with_failed_dependency() == {"deps_failed"}
+
+
+def test_record_missing_job_dependencies(tmp_work_dir):
+    insert(Job(id="foo", state=State.RUNNING))
+    insert(Job(id="bar", state=State.PENDING, wait_for_job_ids=["foo"]))
+    record_missing_job_dependencies()
+    record_missing_job_dependencies()
+    dependencies = find_where(JobDependency)
+    assert dependencies == [JobDependency(job_id="bar", depends_on_id="foo")]
+    assert get_pending_job_ids_ready_to_run() == set()
+
+
+def test_readiness_queries_use_indexes(tmp_work_dir):
+    for func in [
+        get_pending_job_ids_ready_to_run,
+        get_pending_job_ids_with_failed_dependency,
+    ]:
+        sql = get_query(func)
+        rows = get_connection().execute(f"EXPLAIN QUERY PLAN {sql}")
+        details = [row["detail"] for row in rows]
+        assert not any(detail.startswith("SCAN") for detail in details), details
+
+
+def add_job_with_dependencies(job_id, *dependency_ids):
+    insert(Job(id=job_id, state=State.PENDING, wait_for_job_ids=list(dependency_ids)))
+    for dependency_id in dependency_ids:
+        insert(JobDependency(job_id=job_id, depends_on_id=dependency_id))
+
+
+def get_query(func):
+    return get_queries(func)[-1]
+
+
+def get_queries(func):
+    # Capture the SQL the function executes
+    queries = []
+    conn = get_connection()
+    conn.set_trace_callback(queries.append)
+    try:
+        func()
+    finally:
+        conn.set_trace_callback(None)
+    return queries
+
+
+def test_handle_jobs_commits_message_updates_together(tmp_work_dir, monkeypatch):
+    # With no workers available nothing gets started, so we never talk to
+    # Docker and there's nothing to make us commit early
+    monkeypatch.setattr(config, "MAX_WORKERS", 0)
+    add_job_with_dependencies("first")
+    for i in range(3):
+        add_job_with_dependencies(f"waiting{i}", "first")
+    queries = get_queries(run.handle_jobs)
+    assert queries.count("COMMIT") == 1
+    jobs = {job.id: job for job in find_where(Job)}
+    assert jobs["first"].status_message == "Waiting for available workers"
+    assert jobs["waiting0"].status_message == "Waiting on dependencies"
+
+
+def test_handle_jobs_reuses_active_jobs_between_ticks(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(run, "job_still_running", lambda job: True)
+    insert(Job(id="running", state=State.RUNNING))
+    add_job_with_dependencies("waiting", "running")
+    run.handle_jobs()
+    queries = get_queries(run.handle_jobs)
+    assert not any(query.startswith('SELECT "id"') for query in queries), queries
+
+    # Jobs added by another connection get picked up on the next tick
+    thread = threading.Thread(target=add_job_with_dependencies, args=["new"])
+    thread.start()
+    thread.join()
+    active_jobs = run.handle_jobs()
+    assert {job.id for job in active_jobs} == {"running", "waiting", "new"}
+
+
+def test_handle_jobs_commits_before_talking_to_docker(tmp_work_dir, monkeypatch):
+    def job_still_running(job):
+        # Everything written so far must be visible to other connections
+        with read_only():
+            messages = {job.id: job.status_message for job in find_where(Job)}
+        assert messages["waiting"] == "Waiting on dependencies"
+        return True
+
+    monkeypatch.setattr(run, "job_still_running", job_still_running)
+    add_job_with_dependencies("waiting", "running")
+    insert(Job(id="running", state=State.RUNNING))
+    run.handle_jobs()
+
+
+def test_handle_jobs_with_writes_from_other_threads(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(config, "MAX_WORKERS", 2)
+
+    def write_from_another_thread(job):
+        # E.g. the push thread clearing the outbox while we talk to Docker
+        thread = threading.Thread(target=delete_where, args=[JobOutboxItem])
+        thread.start()
+        thread.join()
+        return True
+
+    monkeypatch.setattr(run, "start_job", write_from_another_thread)
+    monkeypatch.setattr(run, "job_still_running", write_from_another_thread)
+    add_job_with_dependencies("pending")
+    insert(Job(id="running", state=State.RUNNING, updated_at=0))
+    run.handle_jobs()
+    with read_only():
+        jobs = {job.id: job for job in find_where(Job)}
+    assert jobs["pending"].state == State.RUNNING
+    assert jobs["running"].updated_at > 0
+
+
+def test_active_jobs_cache_survives_unrelated_writes(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(run, "job_still_running", lambda job: True)
+    insert(Job(id="running", state=State.RUNNING))
+    run.handle_jobs()
+
+    def other_writes():
+        # The sync threads write to the outbox all the time, and update jobs
+        # without changing their state
+        insert(JobOutboxItem(job_id="running"))
+        job = find_where(Job, id="running")[0]
+        job.status_message = "Still running"
+        update(job)
+
+    thread = threading.Thread(target=other_writes)
+    thread.start()
+    thread.join()
+    queries = get_queries(run.handle_jobs)
+    assert not any(query.startswith('SELECT "id"') for query in queries), queries
+
+    # But a change of state does get picked up
+    def change_state():
+        job = find_where(Job, id="running")[0]
+        job.state = State.FAILED
+        update(job)
+
+    thread = threading.Thread(target=change_state)
+    thread.start()
+    thread.join()
+    assert run.handle_jobs() == []
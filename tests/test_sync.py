@@ -1,5 +1,38 @@
-from jobrunner.sync import job_request_from_remote_format
-from jobrunner.models import JobRequest
+import gzip
+import hashlib
+import http.server
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.parse
+
+import pytest
+
+from jobrunner import config, run, sync
+from jobrunner.database import count_where, exists_where, insert
+from jobrunner.models import Job, JobOutboxItem, JobRequest, State
+from jobrunner.run import save_transition
+from jobrunner.sync import (
+    Scheduler,
+    SyncAPIError,
+    api_get_if_changed,
+    api_post,
+    job_request_from_remote_format,
+    send_job_updates,
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_sync_state(monkeypatch):
+    monkeypatch.setattr(sync, "JOB_REQUESTS_VALIDATORS", {})
+    monkeypatch.setattr(sync, "ACTIVE_JOB_REQUEST_IDS", [])
+    monkeypatch.setattr(sync, "BYTES_SENT", {"sent": 0, "uncompressed": 0})
+    monkeypatch.setattr(sync, "JOB_UPDATES_PENDING", threading.Event())
+    monkeypatch.setattr(sync, "FULL_RESYNC_PENDING", threading.Event())
+    monkeypatch.setattr(sync, "PUSHED_JOB_REQUESTS", queue.Queue())
+    monkeypatch.setattr(sync, "JOB_REQUESTS_PUSHED", threading.Event())
 
 
 def test_job_request_from_remote_format():
@@ -27,3 +60,403 @@ def test_job_request_from_remote_format():
     )
     job_request = job_request_from_remote_format(remote_job_request)
     assert job_request == expected
+
+
+def test_send_job_updates(tmp_work_dir, requests_mock, monkeypatch):
+    requests_mock.post("http://testserver/api/v2/jobs/", json={})
+    monkeypatch.setattr(config, "JOB_SERVER_ENDPOINT", "http://testserver/api/v2/")
+    job = Job(id="foo", job_request_id="123", state=State.PENDING)
+    insert(job)
+    job.state = State.RUNNING
+    save_transition(job, 1000)
+    insert(Job(id="bar", job_request_id="123", state=State.FAILED))
+    insert(JobOutboxItem(job_id="bar"))
+
+    send_job_updates()
+    posted = requests_mock.last_request.json()
+    assert [(i["identifier"], i["status"]) for i in posted] == [
+        ("foo", "running"),
+        ("bar", "failed"),
+    ]
+    assert not exists_where(JobOutboxItem)
+
+    # Nothing new to send
+    send_job_updates()
+    assert requests_mock.call_count == 1
+
+
+def test_send_job_updates_in_batches(tmp_work_dir, requests_mock, monkeypatch):
+    requests_mock.post("http://testserver/api/v2/jobs/", json={})
+    monkeypatch.setattr(config, "JOB_SERVER_ENDPOINT", "http://testserver/api/v2/")
+    monkeypatch.setattr(config, "SYNC_BATCH_SIZE", 2)
+    for job_id in ["a", "b", "c"]:
+        insert(Job(id=job_id, state=State.PENDING))
+        insert(JobOutboxItem(job_id=job_id))
+
+    send_job_updates()
+    batches = [
+        [job["identifier"] for job in request.json()]
+        for request in requests_mock.request_history
+    ]
+    assert batches == [["a", "b"], ["c"]]
+
+
+def test_send_job_updates_keeps_outbox_on_error(
+    tmp_work_dir, requests_mock, monkeypatch
+):
+    requests_mock.post("http://testserver/api/v2/jobs/", status_code=503)
+    monkeypatch.setattr(config, "JOB_SERVER_ENDPOINT", "http://testserver/api/v2/")
+    insert(Job(id="foo", state=State.PENDING))
+    insert(JobOutboxItem(job_id="foo"))
+
+    with pytest.raises(SyncAPIError):
+        send_job_updates()
+    assert count_where(JobOutboxItem) == 1
+
+
+def test_scheduler_backs_off_after_errors(monkeypatch):
+    monkeypatch.setattr(config, "SYNC_MAX_BACKOFF", 60)
+    results = [SyncAPIError("down")] * 5 + [None]
+
+    def func():
+        result = results.pop(0)
+        if result:
+            raise result
+
+    scheduler = Scheduler("test", func, interval=5)
+    delays = [scheduler.run_once() for _ in range(6)]
+    assert delays == [10, 20, 40, 60, 60, 5]
+    assert scheduler.metrics()["calls"] == 6
+    assert scheduler.metrics()["errors"] == 5
+    assert scheduler.metrics()["consecutive_errors"] == 0
+
+
+def test_scheduler_full_resync(monkeypatch):
+    calls = []
+    scheduler = Scheduler("test", lambda full_resync: calls.append(full_resync), 5, 60)
+    for _ in range(3):
+        scheduler.run_once()
+    assert calls == [True, False, False]
+    scheduler.last_full_resync -= 60
+    scheduler.run_once()
+    assert calls[-1] is True
+
+
+def test_scheduler_keeps_one_executor_until_stopped():
+    executors = []
+
+    def func(executor):
+        executors.append(executor)
+        if len(executors) == 3:
+            scheduler.stop()
+
+    scheduler = Scheduler("test", func, interval=0, workers=2)
+    thread = threading.Thread(target=scheduler.run_forever, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert len(executors) == 3
+    assert all(executor is scheduler.executor for executor in executors)
+    with pytest.raises(RuntimeError):
+        scheduler.executor.submit(print)
+
+
+def test_scheduler_logs_metrics(monkeypatch, caplog):
+    caplog.set_level(logging.INFO)
+    calls = []
+
+    def func():
+        calls.append(1)
+        if len(calls) == 5:
+            scheduler.stop()
+
+    scheduler = Scheduler("test", func, interval=0)
+    monkeypatch.setattr(scheduler, "metrics_log_interval", 2)
+    scheduler.run_forever()
+    logged = [r.message for r in caplog.records if "metrics" in r.message]
+    assert len(logged) == 2
+    assert logged[-1].startswith("test loop metrics: calls=4 errors=0")
+
+
+def test_sync_full_resync(tmp_work_dir, requests_mock, monkeypatch):
+    monkeypatch.setattr(config, "JOB_SERVER_ENDPOINT", "http://testserver/api/v2/")
+    monkeypatch.setattr(config, "BACKEND", "expectations")
+    monkeypatch.setattr(sync, "create_or_update_jobs", lambda job_request: None)
+    requests_mock.get(
+        "http://testserver/api/v2/job-requests/?backend=expectations",
+        json={"results": [remote_job_request("123")]},
+    )
+    requests_mock.post("http://testserver/api/v2/jobs/", json={})
+    insert(Job(id="foo", job_request_id="123", state=State.SUCCEEDED))
+    insert(Job(id="bar", job_request_id="456", state=State.SUCCEEDED))
+
+    # Nothing has changed so nothing gets POSTed
+    sync.sync()
+    assert requests_mock.call_count == 1
+
+    sync.sync(full_resync=True)
+    posted = requests_mock.last_request.json()
+    assert [job["identifier"] for job in posted] == ["foo"]
+
+
+def remote_job_request(identifier, repo="https://github.com/opensafely/foo"):
+    return {
+        "identifier": identifier,
+        "workspace": {
+            "name": "testing",
+            "repo": repo,
+            "branch": "master",
+            "db": "full",
+        },
+        "requested_actions": ["generate_cohort"],
+        "force_run_dependencies": False,
+    }
+
+
+def test_sync_skips_unchanged_job_requests(tmp_work_dir, job_server, monkeypatch):
+    handled = []
+
+    def create_or_update_jobs(job_request):
+        handled.append(job_request.id)
+
+    monkeypatch.setattr(sync, "create_or_update_jobs", create_or_update_jobs)
+    job_server.job_requests = [remote_job_request("123")]
+
+    sync.sync()
+    sync.sync()
+    assert job_server.statuses == [200, 304]
+    assert handled == ["123"]
+
+    job_server.job_requests.append(remote_job_request("456"))
+    sync.sync()
+    assert job_server.statuses[-1] == 200
+    assert handled == ["123", "123", "456"]
+
+    # A full resync ignores what we've seen before
+    sync.sync(full_resync=True)
+    assert job_server.statuses[-1] == 200
+    assert "If-None-Match" not in job_server.request_headers[-1]
+
+
+def test_sync_retries_job_requests_after_error(tmp_work_dir, job_server, monkeypatch):
+    job_server.job_requests = [remote_job_request("123")]
+
+    def create_or_update_jobs(job_request):
+        raise ValueError()
+
+    monkeypatch.setattr(sync, "create_or_update_jobs", create_or_update_jobs)
+    with pytest.raises(ValueError):
+        sync.sync()
+    monkeypatch.setattr(sync, "create_or_update_jobs", lambda job_request: None)
+    sync.sync()
+    assert job_server.statuses == [200, 200]
+
+
+def test_large_request_bodies_are_compressed(tmp_work_dir, job_server, monkeypatch):
+    monkeypatch.setattr(config, "SYNC_COMPRESSION_THRESHOLD", 1024)
+    for i in range(20):
+        job_id = f"job{i}"
+        insert(Job(id=job_id, state=State.RUNNING, status_message="Running " * 20))
+        insert(JobOutboxItem(job_id=job_id))
+    send_job_updates()
+    api_post("jobs", json=[])
+    assert [encoding for encoding, _ in job_server.posted] == ["gzip", None]
+    assert len(job_server.posted[0][1]) == 20
+    assert sync.BYTES_SENT["sent"] < sync.BYTES_SENT["uncompressed"]
+
+
+def test_request_bodies_are_not_compressed_by_default(tmp_work_dir, job_server):
+    api_post("jobs", json=[{"status_message": "Running " * 1000}])
+    assert [encoding for encoding, _ in job_server.posted] == [None]
+
+
+def test_compressed_responses(tmp_work_dir, job_server, monkeypatch):
+    job_server.job_requests = [remote_job_request("123")]
+    response, _ = api_get_if_changed("job-requests", {})
+    assert "gzip" in job_server.request_headers[-1]["Accept-Encoding"]
+    assert response["results"] == [remote_job_request("123")]
+
+
+def test_sync_handles_paginated_job_requests(
+    tmp_work_dir, job_server, monkeypatch, caplog
+):
+    pages = []
+
+    def handle_job_requests(job_requests, executor=None):
+        pages.append([job_request.id for job_request in job_requests])
+
+    monkeypatch.setattr(sync, "handle_job_requests", handle_job_requests)
+    caplog.set_level(logging.INFO)
+    job_server.page_size = 2
+    job_server.job_requests = [remote_job_request(str(i)) for i in range(5)]
+
+    sync.poll_job_requests()
+    assert pages == [["0", "1"], ["2", "3"], ["4"]]
+    assert sync.ACTIVE_JOB_REQUEST_IDS == ["0", "1", "2", "3", "4"]
+    assert job_server.paths[-1].endswith("cursor=4")
+    assert "Handled 5 JobRequests in 3 pages" in caplog.text
+    # We can't use conditional requests with paginated results
+    sync.poll_job_requests()
+    assert job_server.statuses[-1] == 200
+    assert len(pages) == 6
+
+
+def test_links_outside_job_server_are_not_followed(monkeypatch):
+    monkeypatch.setattr(config, "JOB_SERVER_ENDPOINT", "https://jobs.example.com/api/")
+    assert sync.get_url("job-requests") == "https://jobs.example.com/api/job-requests/"
+    url = "https://jobs.example.com/api/job-requests/?cursor=abc"
+    assert sync.get_url(url) == url
+    with pytest.raises(SyncAPIError):
+        sync.get_url("https://elsewhere.example.com/api/job-requests/?cursor=abc")
+
+
+@pytest.fixture
+def job_server(monkeypatch):
+    """
+    A minimal stand-in for the job-server's API which supports conditional GETs
+    """
+    server = http.server.HTTPServer(("127.0.0.1", 0), JobServerHandler)
+    server.job_requests = []
+    server.statuses = []
+    server.request_headers = []
+    server.posted = []
+    server.paths = []
+    server.page_size = None
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    )
+    thread.start()
+    monkeypatch.setattr(
+        config,
+        "JOB_SERVER_ENDPOINT",
+        f"http://127.0.0.1:{server.server_port}/api/v2/",
+    )
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class JobServerHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.request_headers.append(dict(self.headers))
+        self.server.paths.append(self.path)
+        # Supports cursor-style pagination, where the cursor is just an offset
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        start = int(query.get("cursor", ["0"])[0])
+        end = start + (self.server.page_size or len(self.server.job_requests))
+        page = {"results": self.server.job_requests[start:end], "next": None}
+        if end < len(self.server.job_requests):
+            host, port = self.server.server_address
+            page["next"] = (
+                f"http://{host}:{port}/api/v2/job-requests/?backend=test&cursor={end}"
+            )
+        body = json.dumps(page).encode()
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.respond(304, b"", {"ETag": etag})
+        else:
+            self.respond(200, body, {"ETag": etag})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        encoding = self.headers.get("Content-Encoding")
+        if encoding == "gzip":
+            body = gzip.decompress(body)
+        self.server.posted.append((encoding, json.loads(body)))
+        self.respond(200, b"{}", {})
+
+    def respond(self, status, body, headers):
+        self.server.statuses.append(status)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            headers = dict(headers, **{"Content-Encoding": "gzip"})
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_handle_job_requests_in_parallel(monkeypatch):
+    slow_repo_waiting = threading.Event()
+    fast_repo_done = threading.Event()
+    running = {}
+    max_running = {}
+
+    def create_or_update_jobs(job_request):
+        repo = job_request.repo_url
+        running[repo] = running.get(repo, 0) + 1
+        max_running[repo] = max(max_running.get(repo, 0), running[repo])
+        if repo == "slow":
+            slow_repo_waiting.set()
+            # This only completes if the fast repo doesn't have to wait for us
+            assert fast_repo_done.wait(timeout=5)
+        else:
+            slow_repo_waiting.wait(timeout=5)
+            fast_repo_done.set()
+        running[repo] -= 1
+
+    monkeypatch.setattr(sync, "create_or_update_jobs", create_or_update_jobs)
+    monkeypatch.setattr(config, "SYNC_INTAKE_WORKERS", 4)
+    sync.handle_job_requests(
+        [
+            job_request_from_remote_format(remote_job_request(i, repo=repo))
+            for i, repo in enumerate(["slow", "slow", "fast", "slow", "fast"])
+        ]
+    )
+    # Requests for the same repo never run at the same time
+    assert max_running == {"slow": 1, "fast": 1}
+
+
+def test_handle_job_requests_reraises_errors(monkeypatch):
+    def create_or_update_jobs(job_request):
+        if job_request.repo_url == "broken":
+            raise ValueError()
+
+    monkeypatch.setattr(sync, "create_or_update_jobs", create_or_update_jobs)
+    with pytest.raises(ValueError):
+        sync.handle_job_requests(
+            [
+                job_request_from_remote_format(remote_job_request(1, repo="ok")),
+                job_request_from_remote_format(remote_job_request(2, repo="broken")),
+            ]
+        )
+
+
+def test_state_changes_wake_up_status_reporting(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(config, "SYNC_PUSH_DELAY", 0)
+    _, reporting = sync.get_schedulers()
+    job = Job(id="foo", state=State.PENDING)
+    insert(job)
+    timer = threading.Timer(0.1, run.set_state, args=[job, State.RUNNING, "Running"])
+    timer.start()
+    start = time.time()
+    reporting.wait(timeout=10)
+    assert time.time() - start < 5
+    assert not sync.JOB_UPDATES_PENDING.is_set()
+
+
+def test_pushed_job_requests_are_handled_between_polls(monkeypatch):
+    monkeypatch.setattr(config, "SYNC_PUSH_DELAY", 0)
+    handled = []
+
+    def handle_job_requests(job_requests, executor=None):
+        handled.extend(job_requests)
+
+    monkeypatch.setattr(sync, "handle_job_requests", handle_job_requests)
+    intake, _ = sync.get_schedulers()
+    sync.queue_job_requests([job_request_from_remote_format(remote_job_request("123"))])
+    assert intake.wait(timeout=10)
+    intake.call(intake.wake_func)
+    assert [job_request.id for job_request in handled] == ["123"]
+    assert sync.PUSHED_JOB_REQUESTS.empty()
+    # The new jobs get reported straight away too
+    assert sync.JOB_UPDATES_PENDING.is_set()